@@ -1,10 +1,35 @@
 """Example of grouping commands and sqlite3"""
 import sqlite3
 import csv
+import atexit
+import cProfile
+import glob
+import multiprocessing
+import threading
+import hashlib
+import io
+import json
+import math
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from queue import Empty, Full, Queue
+from itertools import islice
 from pathlib import Path
 import click
-from flask import Flask, g, current_app, render_template
+from flask import (Flask, g, current_app, render_template, request, jsonify, abort,
+                   stream_with_context, before_render_template, template_rendered)
 from flask.cli import AppGroup
+from cache import ResponseCache, cached
+import columns
+import dataprofile
+import metrics
+import snapshot
+import tiles
 
 
 APP = Flask(__name__)
@@ -15,33 +40,316 @@ FACTORDATABASE = 'data/crashData.db'
 MAPDATABASE = 'data/mapData.db'
 APP.config['FACTORDATABASE'] = FACTORDATABASE
 APP.config['MAPDATABASE'] = MAPDATABASE
+APP.config['COLUMNSTORE'] = 'data/mapData-columns.npz'
+APP.config['FACTORSNAPSHOT'] = 'data/snapshot/crashData'
+APP.config['MAPSNAPSHOT'] = 'data/snapshot/mapData'
+APP.config['TILECACHE'] = 'data/tiles'
+APP.config['TILECACHEBYTES'] = 64 * 1024 * 1024
+APP.config['MAXZOOM'] = 18
+APP.config['BATCHSIZE'] = 5000
+# csv bytes in each batch for files flask data profile has seen, their rows per batch
+# come from their bytes per row instead of BATCHSIZE.  None always uses BATCHSIZE
+APP.config['BATCHBYTES'] = 4 * 1024 * 1024
+APP.config['PROFILESTATS'] = 'data/stats'
+APP.config['SQLITE_MMAPSIZE'] = 256 * 1024 * 1024
+APP.config['SQLITE_CACHESIZE'] = -64 * 1024 # negative means KiB, so 64MB
+APP.config['CACHEBYTES'] = 32 * 1024 * 1024
+APP.config['INGESTMETRICS'] = 'data/ingest-metrics.json'
+# when True (or in debug mode) a request with ?profile=1 or an X-Profile header is
+# run under cProfile and the stats are written to PROFILEDIR
+APP.config['PROFILING'] = False
+APP.config['PROFILEDIR'] = 'data/profiles'
+RESPONSECACHE = ResponseCache(APP.config['CACHEBYTES'])
+# the column store currently loaded by this worker, see get_store()
+STORE = {'mtime': None, 'store': None}
+STORELOCK = threading.Lock()
+# the data version and size in bytes of this worker's tile cache, see evict_tiles()
+TILECACHE = {'version': None, 'bytes': 0}
+TILELOCK = threading.Lock()
+# a queue of idle read-only connections for each database, see get_db()
+POOL = dict()
+POOLLOCK = threading.Lock()
+APP.config['POOLSIZE'] = 8
+APP.config['PAGESIZE'] = 100
+APP.config['MAXPAGESIZE'] = 500
+APP.config['MAXBBOXROWS'] = 5000
+SEVERITIES = {'Property damage only', 'Minor injury', 'Medical treatment',
+              'Hospitalisation', 'Fatal'}
+YESNO = {'Yes', 'No'}
+# csv text stored as its ordinal, the view turns the numbers back into the names
+MONTHS = {'January': 1, 'February': 2, 'March': 3, 'April': 4, 'May': 5, 'June': 6, 'July': 7,
+          'August': 8, 'September': 9, 'October': 10, 'November': 11, 'December': 12}
+WEEKDAYS = {'Monday': 1, 'Tuesday': 2, 'Wednesday': 3, 'Thursday': 4, 'Friday': 5,
+            'Saturday': 6, 'Sunday': 7}
+# column and names for each ?by= of the seasonality api, hours are just numbers
+SEASONS = {'month': ('Crash_Month', MONTHS),
+           'weekday': ('Crash_Day_Of_Week', WEEKDAYS),
+           'hour': ('Crash_Hour', None)}
+# severities shown in each section of the list pages
+FACTORGROUPS = {'minor': ('Property damage only', 'Minor injury'),
+                'mid': ('Medical treatment', 'Hospitalisation'),
+                'major': ('Fatal', 'Hospitalisation')}
+MAPGROUPS = {'minor': ('Property damage only', 'Minor injury'),
+             'mid': ('Medical treatment',),
+             'major': ('Fatal', 'Hospitalisation')}
+# columns returned by the crash location api
+CRASHFIELDS = """data.id, Crash_Severity, Crash_Year, Loc_Suburb,
+                 Crash_Longitude_GDA94 AS lon, Crash_Latitude_GDA94 AS lat"""
+# (min lon, min lat, max lon, max lat) of Queensland and the Torres Strait, crashes
+# outside it are reported as outliers by flask data profile
+QLDBOUNDS = (137.9, -29.2, 153.6, -9.0)
+# contributing factors, each one is an Involving_ column of the factor table
+FACTORS = ['drink_driving', 'speed', 'fatigue', 'defective_vehicle']
+# query string parameter to column for the primary key of each rollup table
+ROLLUPKEYS = {'rollup_region': {'year': 'Crash_Year', 'region': 'Crash_Police_Region',
+                                'severity': 'Crash_Severity'},
+              'rollup_factor': {'factor': 'Factor', 'year': 'Crash_Year',
+                                'region': 'Crash_Police_Region'}}
+# (csv column, table column, type, nullable) for each column kept in the tables
+# a set as the type means the value must be one of those strings, a dict means it
+# must be one of its keys and is stored as the matching value
+FACTORSCHEMA = [(0, 'Crash_Year', int, False),
+                (1, 'Crash_Police_Region', str, False),
+                (2, 'Crash_Severity', SEVERITIES, False),
+                (3, 'Involving_Drink_Driving', YESNO, False),
+                (4, 'Involving_Driver_Speed', YESNO, False),
+                (5, 'Involving_Fatigued_Driver', YESNO, False),
+                (6, 'Involving_Defective_Vehicle', YESNO, False),
+                (7, 'Count_Crashes', int, False),
+                (8, 'Count_Fatality', int, False),
+                (9, 'Count_Hospitalised', int, False),
+                (10, 'Count_Medically_Treated', int, False),
+                (11, 'Count_Minor_Injury', int, False),
+                (12, 'Count_All_Casualties', int, False)]
+MAPSCHEMA = [(0, 'id', int, False), # Crash_Ref_Number
+             (1, 'Crash_Severity', SEVERITIES, False),
+             (2, 'Crash_Year', int, False),
+             (3, 'Crash_Month', MONTHS, False),
+             (4, 'Crash_Day_Of_Week', WEEKDAYS, False),
+             (13, 'Loc_Suburb', str, True),
+             (15, 'Loc_Post_Code', int, True),
+             (16, 'Loc_Police_Division', str, True),
+             (17, 'Loc_Police_District', str, True),
+             (18, 'Loc_Police_Region', str, True),
+             (40, 'Count_Casualty_Fatality', int, False),
+             (41, 'Count_Casualty_Hospitalised', int, False),
+             (42, 'Count_Casualty_MedicallyTreated', int, False),
+             (43, 'Count_Casualty_MinorInjury', int, False),
+             (44, 'Count_Casualty_Total', int, False),
+             (8, 'Crash_Longitude_GDA94', float, True),
+             (9, 'Crash_Latitude_GDA94', float, True),
+             (5, 'Crash_Hour', int, True)]
+# map csv columns kept only in the column store, see columns.py.  they are validated
+# in the same pass as MAPSCHEMA, so the store and the table hold the same crashes
+STORESCHEMA = [(6, 'Crash_Nature', str, True),
+               (7, 'Crash_Type', str, True),
+               (14, 'Loc_Local_Government_Area', str, True),
+               (19, 'Loc_Queensland_Transport_Region', str, True),
+               (20, 'Loc_Main_Roads_Region', str, True),
+               (23, 'Loc_ABS_Statistical_Area_4', str, True),
+               (24, 'Loc_ABS_Remoteness', str, True),
+               (25, 'Loc_State_Electorate', str, True),
+               (26, 'Loc_Federal_Electorate', str, True),
+               (27, 'Crash_Controlling_Authority', str, True),
+               (28, 'Crash_Roadway_Feature', str, True),
+               (29, 'Crash_Traffic_Control', str, True),
+               (30, 'Crash_Speed_Limit', str, True),
+               (31, 'Crash_Road_Surface_Condition', str, True),
+               (32, 'Crash_Atmospheric_Condition', str, True),
+               (33, 'Crash_Lighting_Condition', str, True),
+               (34, 'Crash_Road_Horiz_Align', str, True),
+               (35, 'Crash_Road_Vert_Align', str, True),
+               (36, 'Crash_DCA_Code', int, True),
+               (38, 'Crash_DCA_Group_Description', str, True),
+               (39, 'DCA_Key_Approach_Dir', str, True),
+               (45, 'Count_Unit_Car', int, True),
+               (46, 'Count_Unit_Motorcycle_Moped', int, True),
+               (47, 'Count_Unit_Truck', int, True),
+               (48, 'Count_Unit_Bus', int, True),
+               (49, 'Count_Unit_Bicycle', int, True),
+               (50, 'Count_Unit_Pedestrian', int, True),
+               (51, 'Count_Unit_Other', int, True)]
+# columns and filters of each dataset in the v1 json api, the filters are query
+# string parameter to column
+APIDATASETS = {'factors': {'database': 'FACTORDATABASE',
+                           'fields': ['id'] + [name for _, name, _, _ in FACTORSCHEMA],
+                           'filters': {'year': 'Crash_Year', 'region': 'Crash_Police_Region',
+                                       'severity': 'Crash_Severity'}},
+               'crashes': {'database': 'MAPDATABASE',
+                           'fields': [name for _, name, _, _ in MAPSCHEMA],
+                           'filters': {'year': 'Crash_Year', 'region': 'Loc_Police_Region',
+                                       'severity': 'Crash_Severity'}}}
+# rows fetched from the cursor at a time while streaming
+APIFETCH = 500
+# queries across both datasets, run on the connection from get_bothdb() where the
+# factor database is attached as factor and the map database as map.  :year and
+# :region are the optional filters, NULL matches everything
+# the map rows are read from the encoded table, so only the lookups needed are joined.
+# the filters are applied inside each part so the map side reads only the matching
+# rows through region_year_idx, rather than totalling the whole table every time
+MAPFILTER = """encoded.Loc_Police_Region IN (SELECT code FROM map.region
+                                             WHERE :region IS NULL OR label = :region)
+               AND encoded.Crash_Year BETWEEN IFNULL(:year, 0) AND IFNULL(:year, 9999)"""
+CROSSKEYS = f"""SELECT Crash_Year, Crash_Police_Region AS region FROM factor.rollup_region
+               WHERE (:year IS NULL OR Crash_Year = :year)
+               AND (:region IS NULL OR Crash_Police_Region = :region)
+               UNION SELECT Crash_Year, region.label FROM map.encoded
+               JOIN map.region AS region ON region.code = encoded.Loc_Police_Region
+               WHERE {MAPFILTER}"""
+CROSSQUERIES = {
+    # crashes on the map next to the factor totals and how many involved each factor
+    'regions': f"""WITH keys AS ({CROSSKEYS}),
+                   located AS (SELECT Crash_Year, region.label AS region,
+                               COUNT(*) AS located_crashes,
+                               SUM(Count_Casualty_Fatality) AS located_fatalities,
+                               SUM(Count_Casualty_Total) AS located_casualties
+                               FROM map.encoded
+                               JOIN map.region AS region ON region.code = encoded.Loc_Police_Region
+                               WHERE {MAPFILTER}
+                               GROUP BY Crash_Year, region.label),
+                   totals AS (SELECT Crash_Year, Crash_Police_Region AS region,
+                              SUM(Count_Crashes) AS crashes,
+                              SUM(Count_Fatality) AS fatalities,
+                              SUM(Count_All_Casualties) AS casualties
+                              FROM factor.rollup_region GROUP BY Crash_Year, Crash_Police_Region),
+                   factors AS (SELECT Crash_Year, Crash_Police_Region AS region,
+                               SUM(CASE Factor WHEN 'drink_driving' THEN Count_Crashes END) AS drink_driving,
+                               SUM(CASE Factor WHEN 'speed' THEN Count_Crashes END) AS speed,
+                               SUM(CASE Factor WHEN 'fatigue' THEN Count_Crashes END) AS fatigue,
+                               SUM(CASE Factor WHEN 'defective_vehicle' THEN Count_Crashes END)
+                                   AS defective_vehicle
+                               FROM factor.rollup_factor GROUP BY Crash_Year, Crash_Police_Region)
+                   SELECT keys.Crash_Year AS year, keys.region AS region,
+                   IFNULL(located_crashes, 0) AS located_crashes,
+                   IFNULL(located_fatalities, 0) AS located_fatalities,
+                   IFNULL(located_casualties, 0) AS located_casualties,
+                   IFNULL(crashes, 0) AS crashes, IFNULL(fatalities, 0) AS fatalities,
+                   IFNULL(casualties, 0) AS casualties,
+                   IFNULL(drink_driving, 0) AS drink_driving, IFNULL(speed, 0) AS speed,
+                   IFNULL(fatigue, 0) AS fatigue, IFNULL(defective_vehicle, 0) AS defective_vehicle
+                   FROM keys
+                   LEFT JOIN located USING (Crash_Year, region)
+                   LEFT JOIN totals USING (Crash_Year, region)
+                   LEFT JOIN factors USING (Crash_Year, region)
+                   ORDER BY keys.Crash_Year, keys.region;""",
+    # the same comparison split by severity
+    'severity': f"""WITH keys AS (SELECT keys.*, severity.label AS severity
+                                  FROM ({CROSSKEYS}) AS keys, factor.severity),
+                    located AS (SELECT Crash_Year, region.label AS region, severity.label AS severity,
+                                COUNT(*) AS located_crashes
+                                FROM map.encoded
+                                JOIN map.region AS region ON region.code = encoded.Loc_Police_Region
+                                JOIN map.severity AS severity ON severity.code = encoded.Crash_Severity
+                                WHERE {MAPFILTER}
+                                GROUP BY Crash_Year, region.label, severity.label)
+                    SELECT keys.Crash_Year AS year, keys.region AS region, keys.severity AS severity,
+                    IFNULL(located_crashes, 0) AS located_crashes,
+                    IFNULL(rollup.Count_Crashes, 0) AS crashes,
+                    IFNULL(rollup.Count_All_Casualties, 0) AS casualties
+                    FROM keys
+                    LEFT JOIN located USING (Crash_Year, region, severity)
+                    LEFT JOIN factor.rollup_region AS rollup
+                    ON rollup.Crash_Year = keys.Crash_Year AND rollup.Crash_Police_Region = keys.region
+                    AND rollup.Crash_Severity = keys.severity
+                    WHERE (located_crashes IS NOT NULL OR rollup.Count_Crashes IS NOT NULL)
+                    ORDER BY keys.Crash_Year, keys.region, keys.severity;"""}
+# csv values stored as NULL in nullable columns
+NULLS = {'', 'Unknown'}
+FACTORINSERT = """INSERT INTO encoded (
+               Crash_Year,
+               Crash_Police_Region,
+               Crash_Severity,
+               Involving_Drink_Driving,
+               Involving_Driver_Speed,
+               Involving_Fatigued_Driver,
+               Involving_Defective_Vehicle,
+               Count_Crashes,
+               Count_Fatality,
+               Count_Hospitalised,
+               Count_Medically_Treated,
+               Count_Minor_Injury,
+               Count_All_Casualties) VALUES
+               (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);"""
+MAPINSERT = """INSERT OR IGNORE INTO encoded (
+               id,
+               Crash_Severity,
+               Crash_Year,
+               Crash_Month,
+               Crash_Day_Of_Week,
+               Loc_Suburb,
+               Loc_Post_Code,
+               Loc_Police_Division,
+               Loc_Police_District,
+               Loc_Police_Region,
+               Count_Casualty_Fatality,
+               Count_Casualty_Hospitalised,
+               Count_Casualty_MedicallyTreated,
+               Count_Casualty_MinorInjury,
+               Count_Casualty_Total,
+               Crash_Longitude_GDA94,
+               Crash_Latitude_GDA94,
+               Crash_Hour) VALUES
+               (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);"""
+# categorical columns stored as a code from a lookup table, see encode_batch().
+# None means a Yes/No flag, stored as 1 or 0
+FACTORLOOKUPS = {'Crash_Police_Region': 'region',
+                 'Crash_Severity': 'severity',
+                 'Involving_Drink_Driving': None,
+                 'Involving_Driver_Speed': None,
+                 'Involving_Fatigued_Driver': None,
+                 'Involving_Defective_Vehicle': None}
+MAPLOOKUPS = {'Crash_Severity': 'severity',
+              'Loc_Suburb': 'suburb',
+              'Loc_Police_Division': 'division',
+              'Loc_Police_District': 'district',
+              'Loc_Police_Region': 'region'}
+# where each dataset goes and how its rows are stored.  schema is every column that
+# is validated, table the columns at the start of it that go into the table
+DATASETS = {'factor': {'header': 'Crash_Year', 'database': 'FACTORDATABASE',
+                       'schema': FACTORSCHEMA, 'table': FACTORSCHEMA,
+                       'insert': FACTORINSERT, 'lookups': FACTORLOOKUPS},
+            'map': {'header': 'Crash_Ref_Number', 'database': 'MAPDATABASE',
+                    'schema': MAPSCHEMA + STORESCHEMA, 'table': MAPSCHEMA,
+                    'insert': MAPINSERT, 'lookups': MAPLOOKUPS}}
+# pages requested by flask data explain to find the queries the app runs, {factor}
+# and {crash} are replaced with ids from the databases
+EXPLAINURLS = ['/factorList', '/factorList?after={factor}', '/factorList/{factor}',
+               '/locationList', '/locationList?after={crash}', '/locationList/{crash}',
+               '/search?q=brisbane', '/search?q=fatal&dataset=factor&after={factor}',
+               '/api/stats/regions?year=2002', '/api/stats/factors?factor=speed&year=2002',
+               '/api/crashes?bbox=152.5,-28,153.5,-27', '/api/crashes/nearest?lon=153&lat=-27.5',
+               '/api/v1/factors?year=2002&region=Central&limit=10',
+               '/api/v1/crashes?severity=Fatal&limit=10', '/api/v1/crashes/{crash}',
+               '/api/v1/seasonality?by=month&from=2001&to=2002',
+               '/api/v1/seasonality?by=hour&region=Central',
+               '/api/v1/seasonality?by=weekday&severity=Fatal',
+               '/api/v1/compare/regions?year=2002', '/api/v1/compare/severity?region=Central']
+# bytes checked before the watermark to make sure the file was only appended to
+TAILSIZE = 4096
 
 
 """ --------------------------- Pages and Routes ----------------------------------- """
 @APP.route('/')
 def home():
-    initdb_factor()
-    initdb_map()
     return render_template('home.html')
 
 @APP.route('/factorList')
+@cached(RESPONSECACHE, lambda: dataset_version())
 def factorList():
-    upload_factor('data/crashData-CSV.csv')
-    dataout = []
-    crashID = []
+    after, limit = get_pageargs()
+    groups = {name: [] for name in FACTORGROUPS}
+    pages = (None, None)
     try:
         conn = get_factordb()
         if conn:
-            rows = conn.execute("SELECT*FROM data;")
-            for row in rows:
-                dataout.append(row)
-                crashID.append(int(row[0]))
+            groups, pages = get_groups(conn, FACTORGROUPS, after, limit)
     except sqlite3.DatabaseError as err:
         print("Error\n", err)
-    close_db()
-    return render_template('factorList.html', getcrashdata = dataout, IDcrash = crashID)
+    return render_template('factorList.html', **groups, prevpage = pages[0], nextpage = pages[1],
+                           limit = limit)
 
 @APP.route("/factorList/<int:IDcrash>")
+@cached(RESPONSECACHE, lambda: dataset_version())
 def factor(IDcrash):
     conn = get_factordb()
     crashRows = conn.execute("SELECT * FROM data WHERE id =?;", (IDcrash,))
@@ -54,23 +362,22 @@ def factor(IDcrash):
 """------------------------------------------------------------------------------------------------------------------------------"""
 
 @APP.route('/locationList')
+@cached(RESPONSECACHE, lambda: dataset_version())
 def locationList():
-    upload_map('data/mapData-CSV.csv')
-    mapdataout = []
-    mapID = []
+    after, limit = get_pageargs()
+    groups = {name: [] for name in MAPGROUPS}
+    pages = (None, None)
     try:
         conn = get_mapdb()
         if conn:
-            rows = conn.execute("SELECT*FROM data;")
-            for row in rows:
-                mapdataout.append(row)
-                mapID.append(row[0])
+            groups, pages = get_groups(conn, MAPGROUPS, after, limit)
     except sqlite3.DatabaseError as err:
         print("Error\n", err)
-    close_db()
-    return render_template('locationList.html', getmapdata = mapdataout, IDmap = mapID)
+    return render_template('locationList.html', **groups, prevpage = pages[0], nextpage = pages[1],
+                           limit = limit)
 
 @APP.route("/locationList/<int:IDmap>")
+@cached(RESPONSECACHE, lambda: dataset_version())
 def location(IDmap):
     conn = get_mapdb()
     mapRows = conn.execute("SELECT * FROM data WHERE id =?;", (IDmap,))
@@ -80,6 +387,147 @@ def location(IDmap):
 
     return render_template("location.html", columns=mapInfo, IDmap = IDmap)
 
+@APP.route('/search')
+def search():
+    query = request.args.get('q', '').strip()
+    dataset = 'factor' if request.args.get('dataset') == 'factor' else 'location'
+    after, limit = get_pageargs()
+    results = []
+    pages = (None, None)
+    if query:
+        try:
+            conn = get_factordb() if dataset == 'factor' else get_mapdb()
+            if conn:
+                results, pages = search_rows(conn, query, after, limit)
+        except sqlite3.DatabaseError as err:
+            print("Error\n", err)
+    return render_template('search.html', results = results, query = query, dataset = dataset,
+                           prevpage = pages[0], nextpage = pages[1], limit = limit)
+
+@APP.route('/api/stats/regions')
+def region_stats():
+    return jsonify(get_rollup('rollup_region', ROLLUPKEYS['rollup_region']))
+
+@APP.route('/api/stats/factors')
+def factor_stats():
+    if request.args.get('factor') not in (None, *FACTORS):
+        abort(400, f"factor must be one of {FACTORS}")
+    return jsonify(get_rollup('rollup_factor', ROLLUPKEYS['rollup_factor']))
+
+@APP.route('/api/analytics')
+def analytics():
+    store = get_store()
+    if store is None:
+        abort(503, "the column store has not been built, run flask data load with numpy installed")
+    if store.version != store_version(get_mapdb()):
+        abort(503, "the column store is older than the map data, run flask data load --force")
+    args = request.args.to_dict(flat=False)
+    # ?profile=1 is for the profiler, not a column
+    args.pop('profile', None)
+    by = args.pop('by', ['Crash_Year'])[0]
+    agg = args.pop('agg', ['count'])[0]
+    value = args.pop('value', [None])[0]
+    try:
+        groups = store.groupby(by, args, value, agg)
+    except KeyError as err:
+        abort(400, f"unknown column {err}")
+    except ValueError as err:
+        abort(400, str(err))
+    return jsonify({'by': by, 'agg': agg, 'value': value, 'groups': groups})
+
+@APP.route('/api/crashes')
+def crashes_in_box():
+    try:
+        minlon, minlat, maxlon, maxlat = (float(part) for part in request.args['bbox'].split(','))
+    except (KeyError, ValueError):
+        abort(400, "bbox must be minlon,minlat,maxlon,maxlat")
+    limit = min(max(request.args.get('limit', APP.config['MAXBBOXROWS'], type=int), 1),
+                APP.config['MAXBBOXROWS'])
+    rows = get_mapdb().execute(f"""SELECT {CRASHFIELDS} FROM spatial JOIN data ON data.id = spatial.id
+                                   WHERE minlon >=? AND maxlon <=? AND minlat >=? AND maxlat <=?
+                                   LIMIT ?;""", (minlon, maxlon, minlat, maxlat, limit + 1)).fetchall()
+    return jsonify({'crashes': [dict(row) for row in rows[:limit]], 'truncated': len(rows) > limit})
+
+@APP.route('/api/crashes/nearest')
+def nearest_crashes():
+    lon = request.args.get('lon', type=float)
+    lat = request.args.get('lat', type=float)
+    if lon is None or lat is None:
+        abort(400, "lon and lat are required")
+    k = min(max(request.args.get('k', 10, type=int), 1), APP.config['MAXPAGESIZE'])
+    return jsonify({'crashes': get_nearest(get_mapdb(), lon, lat, k)})
+
+@APP.route('/api/v1/factors')
+def api_factors():
+    return stream_rows('factors')
+
+@APP.route('/api/v1/crashes')
+def api_crashes():
+    return stream_rows('crashes')
+
+@APP.route('/api/v1/crashes/<int:IDmap>')
+def api_crash(IDmap):
+    fields = get_fields(APIDATASETS['crashes'])
+    conn = get_db(APP.config['MAPDATABASE'])
+    row = conn.execute(f"SELECT {', '.join(fields)} FROM data WHERE id =?;", (IDmap,)).fetchone()
+    if row is None:
+        abort(404, f"there is no crash {IDmap}")
+    return jsonify(dict(row))
+
+@APP.route('/api/v1/seasonality')
+def seasonality():
+    by = request.args.get('by', 'month')
+    if by not in SEASONS:
+        abort(400, f"by must be one of {list(SEASONS)}")
+    column, names = SEASONS[by]
+    first = request.args.get('from', 0, type=int)
+    last = request.args.get('to', 9999, type=int)
+    # filter on the codes so the region and severity indexes can be used
+    where = ["Crash_Year BETWEEN ? AND ?"]
+    params = [first, last]
+    for arg, table, code in (('region', 'region', 'Loc_Police_Region'),
+                             ('severity', 'severity', 'Crash_Severity')):
+        if request.args.get(arg):
+            where.append(f"{code} = (SELECT code FROM {table} WHERE label =?)")
+            params.append(request.args[arg])
+    rows = get_mapdb().execute(f"""SELECT {column} AS period, COUNT(*) AS crashes FROM encoded
+                                   WHERE {' AND '.join(where)} AND {column} IS NOT NULL
+                                   GROUP BY {column} ORDER BY {column};""", params).fetchall()
+    labels = {number: name for name, number in (names or dict()).items()}
+    return jsonify([{by: labels.get(row['period'], row['period']), 'crashes': row['crashes']}
+                    for row in rows])
+
+@APP.route('/api/v1/compare/<name>')
+def compare(name):
+    if name not in CROSSQUERIES:
+        abort(404, f"comparisons are {sorted(CROSSQUERIES)}")
+    year = request.args.get('year')
+    if year is not None and not year.isdigit():
+        abort(400, "year must be a whole number")
+    params = {'year': int(year) if year else None, 'region': request.args.get('region')}
+    rows = get_bothdb().execute(CROSSQUERIES[name], params).fetchall()
+    return jsonify([dict(row) for row in rows])
+
+@APP.route('/tiles/<int:z>/<int:x>/<int:y>.<fmt>')
+def tile(z, x, y, fmt):
+    if fmt not in ('png', 'json') or not 0 <= z <= APP.config['MAXZOOM']:
+        abort(404)
+    if not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        abort(404)
+    # tiles only show the map data, loading the factor data leaves them as they are
+    version = store_version(get_mapdb())[:16]
+    path = Path(APP.config['TILECACHE'], version, str(z), str(x), f"{y}.{fmt}")
+    try:
+        # the mtime is used as the last time the tile was used when evicting
+        os.utime(path)
+        data = path.read_bytes()
+    except FileNotFoundError:
+        # not built yet, or evicted since, by this request or another one
+        built = build_tile(version, z, x, y)
+        evict_tiles(version, sum(len(tile) for tile in built.values()))
+        data = built[fmt]
+    return APP.response_class(data, mimetype='image/png' if fmt == 'png' else 'application/json')
+
 @APP.route('/help')
 def help():
     return render_template('help.html')
@@ -92,6 +540,62 @@ def report():
 def bruh():
     return render_template('bruh.html')
 
+@APP.route('/metrics')
+def metrics_page():
+    text = metrics.REGISTRY.render(metrics.read_ingest(APP.config['INGESTMETRICS']))
+    return APP.response_class(text, mimetype='text/plain; version=0.0.4')
+
+""" ----------------------------------- Instrumentation ----------------------------------- """
+@APP.before_request
+def start_timers():
+    """start timing the request, and profiling it if that was asked for and is allowed"""
+    g.phases = {'db': 0.0, 'render': 0.0}
+    g.started = time.perf_counter()
+    wanted = request.args.get('profile') == '1' or 'X-Profile' in request.headers
+    if wanted and (APP.config['PROFILING'] or APP.debug):
+        g.profile = cProfile.Profile()
+        g.profile.enable()
+
+@APP.after_request
+def record_timers(response):
+    """record how long the request took and where the time went, for a streamed
+    response once the last of it has been written"""
+    timers = (request.endpoint or 'unmatched', request.method, g.started, g.phases, g.pop('profile', None))
+    if g.pop('streaming', False):
+        response.call_on_close(lambda: finish_timers(response, *timers, streamed=True))
+    else:
+        finish_timers(response, *timers)
+    return response
+
+def finish_timers(response, route, method, started, phases, profile, streamed=False):
+    """stop the profiler and record the timers of a finished request"""
+    if profile is not None:
+        profile.disable()
+        folder = Path(APP.config['PROFILEDIR'])
+        folder.mkdir(parents=True, exist_ok=True)
+        path = folder / f"{datetime.now():%Y%m%d-%H%M%S-%f}-{route}-{os.getpid()}.prof"
+        profile.dump_stats(path)
+        if not streamed:
+            # the headers of a streamed response went out before it was profiled
+            response.headers['X-Profile-File'] = path.name
+    total = time.perf_counter() - started
+    metrics.REGISTRY.inc('crash_http_requests_total', {'route': route, 'method': method,
+                                                       'status': response.status_code})
+    metrics.REGISTRY.observe('crash_http_request_seconds', {'route': route}, total)
+    # whatever is not sqlite or templates is the view turning rows into python objects
+    phases = dict(phases, materialize=max(total - phases['db'] - phases['render'], 0.0))
+    for phase, seconds in phases.items():
+        metrics.REGISTRY.inc('crash_http_phase_seconds_total', {'route': route, 'phase': phase}, seconds)
+
+@before_render_template.connect_via(APP)
+def start_render(sender, template, context, **extra):
+    g.renderstart = time.perf_counter()
+
+@template_rendered.connect_via(APP)
+def end_render(sender, template, context, **extra):
+    if 'renderstart' in g:
+        metrics.add_phase('render', time.perf_counter() - g.pop('renderstart'))
+
 
 """ ----------------------------------- Functions ----------------------------------- """
 def isfile(file):
@@ -99,215 +603,1599 @@ def isfile(file):
     dbfile = Path(file)
     return dbfile.is_file()
 
+def get_pageargs():
+    """return the after id and page size from the query string, keeping the size in bounds"""
+    after = request.args.get('after', 0, type=int)
+    limit = request.args.get('limit', APP.config['PAGESIZE'], type=int)
+    return (max(after, 0), min(max(limit, 1), APP.config['MAXPAGESIZE']))
+
+def get_groups(conn, groups, after, limit):
+    """return one page of rows for each severity group
+
+    a page is the next limit ids after the after id, so each query is a range
+    scan of the severity index no matter how big the table is
+
+        Returns:
+            A tuple.  The tuple contains two elements
+                [0] - dictionary of group name to the list of rows in that group
+                [1] - tuple of the after id for the previous and next pages, None if
+                      there is no such page
+    """
+    ids = conn.execute("SELECT id FROM data WHERE id >? ORDER BY id LIMIT ?;",
+                       (after, limit + 1)).fetchall()
+    # last id on this page, one extra id was fetched to see if there is a next page
+    last = ids[:limit][-1][0] if ids else after
+    nextpage = last if len(ids) > limit else None
+    prevpage = None
+    if after > 0:
+        before = conn.execute("SELECT id FROM data WHERE id <=? ORDER BY id DESC LIMIT 1 OFFSET ?;",
+                              (after, limit)).fetchone()
+        prevpage = before[0] if before else 0
+    result = dict()
+    for name, severities in groups.items():
+        marks = ", ".join("?" * len(severities))
+        result[name] = conn.execute(f"""SELECT * FROM data
+                                        WHERE Crash_Severity IN ({marks})
+                                        AND id >? AND id <=?
+                                        ORDER BY id;""",
+                                    (*severities, after, last)).fetchall()
+    return (result, (prevpage, nextpage))
+
+def get_fields(dataset):
+    """return the columns asked for with ?fields=a,b from the columns of an api dataset"""
+    fields = request.args.get('fields')
+    if not fields:
+        return dataset['fields']
+    fields = [field.strip() for field in fields.split(',') if field.strip()]
+    unknown = [field for field in fields if field not in dataset['fields']]
+    if unknown or not fields:
+        abort(400, f"fields must be some of {dataset['fields']}")
+    return fields
+
+def api_query(dataset):
+    """return the sql and parameters selecting the rows of an api dataset that match
+    the filters, after id and limit in the query string"""
+    fields = get_fields(dataset)
+    where = ["id >?"]
+    params = [max(request.args.get('after', 0, type=int), 0)]
+    for arg, column in dataset['filters'].items():
+        # each filter can be repeated or comma separated to match any of several values
+        values = [value for given in request.args.getlist(arg) for value in given.split(',') if value]
+        if not values:
+            continue
+        if column == 'Crash_Year':
+            if not all(value.isdigit() for value in values):
+                abort(400, "year must be a whole number")
+            values = [int(value) for value in values]
+        where.append(f"{column} IN ({', '.join('?' * len(values))})")
+        params += values
+    sql = f"SELECT {', '.join(fields)} FROM data WHERE {' AND '.join(where)} ORDER BY id"
+    limit = request.args.get('limit', type=int)
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(max(limit, 0))
+    return (sql + ";", params)
+
+def stream_rows(name):
+    """stream the rows of an api dataset matching the query string
+
+    rows are written as they come off the sqlite cursor, a few hundred at a time,
+    so memory use is the same for ten rows or the whole table.  ?format=ndjson or
+    an Accept of application/x-ndjson gives one json object per line, otherwise
+    the response is a json array"""
+    dataset = APIDATASETS[name]
+    sql, params = api_query(dataset)
+    ndjson = (request.args.get('format') == 'ndjson'
+              or request.accept_mimetypes.best == 'application/x-ndjson')
+    cursor = get_db(APP.config[dataset['database']]).execute(sql, params)
+    # the timers and any profiler stop once the rows have been written, not here
+    g.streaming = True
+
+    def generate():
+        first = True
+        try:
+            if not ndjson:
+                yield "["
+            while True:
+                rows = cursor.fetchmany(APIFETCH)
+                if not rows:
+                    break
+                if ndjson:
+                    yield "".join(json.dumps(dict(row)) + "\n" for row in rows)
+                else:
+                    yield ("" if first else ",") + ",".join(json.dumps(dict(row)) for row in rows)
+                first = False
+            if not ndjson:
+                yield "]"
+        finally:
+            # also when the client goes away part way through
+            cursor.close()
+
+    return APP.response_class(stream_with_context(generate()),
+                              mimetype='application/x-ndjson' if ndjson else 'application/json')
+
+def fts_query(text):
+    """turn what the user typed into an fts5 query matching every word as a prefix"""
+    words = text.replace('"', ' ').split()
+    return " ".join(f'"{word}"*' for word in words)
+
+def search_rows(conn, text, after, limit):
+    """return one page of rows matching the search text, using the fts5 index
+
+        Returns:
+            A tuple.  The tuple contains two elements
+                [0] - list of the matching rows
+                [1] - tuple of the after id for the previous and next pages, None if
+                      there is no such page
+    """
+    query = fts_query(text)
+    if not query:
+        return ([], (None, None))
+    rows = conn.execute("""SELECT data.* FROM search JOIN data ON data.id = search.rowid
+                           WHERE search MATCH ? AND search.rowid >?
+                           ORDER BY search.rowid LIMIT ?;""", (query, after, limit + 1)).fetchall()
+    nextpage = rows[limit - 1]['id'] if len(rows) > limit else None
+    prevpage = None
+    if after > 0:
+        before = conn.execute("""SELECT rowid FROM search WHERE search MATCH ? AND rowid <=?
+                                 ORDER BY rowid DESC LIMIT 1 OFFSET ?;""",
+                              (query, after, limit)).fetchone()
+        prevpage = before[0] if before else 0
+    return (rows[:limit], (prevpage, nextpage))
+
+def distance_km(lon1, lat1, lon2, lat2):
+    """return the approximate distance between two points, fine for the short distances here"""
+    x = (lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2)) * 111.32
+    y = (lat2 - lat1) * 110.57
+    return math.hypot(x, y)
+
+def get_nearest(conn, lon, lat, k):
+    """return the k crashes closest to a point as dictionaries with their distance
+
+    the r-tree is searched with a box that doubles in size until it holds k crashes
+    and the kth closest of them is inside the circle the box contains, so nothing
+    outside the box can be closer"""
+    radius = 0.01
+    while True:
+        # degrees of longitude get shorter away from the equator
+        width = radius / max(math.cos(math.radians(lat)), 0.01)
+        rows = conn.execute(f"""SELECT {CRASHFIELDS} FROM spatial JOIN data ON data.id = spatial.id
+                                WHERE minlon >=? AND maxlon <=? AND minlat >=? AND maxlat <=?;""",
+                            (lon - width, lon + width, lat - radius, lat + radius)).fetchall()
+        found = sorted(((distance_km(lon, lat, row['lon'], row['lat']), dict(row)) for row in rows),
+                       key=lambda pair: pair[0])
+        # radius in degrees of latitude, converted to km to compare with the distances
+        if (len(found) >= k and found[k - 1][0] <= radius * 110.57) or radius > 180:
+            return [dict(crash, distance_km=round(distance, 3)) for distance, crash in found[:k]]
+        radius *= 2
+
+def build_tile(version, z, x, y):
+    """count the crashes in a tile and save it to the tile cache as png and json
+
+        Returns:
+            A dictionary of 'png' and 'json' to the bytes of the tile in that format
+    """
+    minlon, minlat, maxlon, maxlat = tiles.tile_bounds(z, x, y)
+    points = get_mapdb().execute("""SELECT minlon, minlat FROM spatial
+                                    WHERE minlon >=? AND maxlon <=? AND minlat >=? AND maxlat <=?;""",
+                                 (minlon, maxlon, minlat, maxlat))
+    grid = tiles.bin_points(points, z, x, y)
+    data = {'json': json.dumps({'z': z, 'x': x, 'y': y, 'grid': grid}).encode(),
+            'png': tiles.render_png(grid)}
+    folder = Path(APP.config['TILECACHE'], version, str(z), str(x))
+    folder.mkdir(parents=True, exist_ok=True)
+    for fmt, tile in data.items():
+        # write then rename so nothing serves half a tile, each request gets its own
+        # temporary file as threads building the same tile would clash on a fixed name
+        handle, tmpfile = tempfile.mkstemp(dir=folder, suffix='.tmp')
+        with os.fdopen(handle, mode='wb') as tilefile:
+            tilefile.write(tile)
+        os.replace(tmpfile, folder / f"{y}.{fmt}")
+    return data
+
+def tile_files(folder):
+    """return (mtime, size, path) for each tile saved under folder"""
+    files = []
+    for path in Path(folder).rglob('*.*'):
+        if path.suffix == '.tmp':
+            # still being written by build_tile()
+            continue
+        try:
+            info = path.stat()
+        except FileNotFoundError:
+            continue
+        files.append((info.st_mtime, info.st_size, path))
+    return files
+
+def evict_tiles(version, added):
+    """count added bytes of newly built tiles against the tile cache, then remove the
+    least recently used tiles if the cache is over TILECACHEBYTES
+
+    the size of the cache is kept in TILECACHE, so the tiles are only listed when the
+    version changes, which also removes the tiles of older versions, and when there
+    is something to evict.  eviction goes down to 3/4 of TILECACHEBYTES so it is not
+    run again on the next miss.  each worker keeps its own count, which is put right
+    whenever it lists the tiles"""
+    cache = Path(APP.config['TILECACHE'])
+    with TILELOCK:
+        if TILECACHE['version'] != version:
+            for folder in cache.iterdir():
+                if folder.name != version:
+                    shutil.rmtree(folder, ignore_errors=True)
+            # the new tile is already saved, so it is in the listing
+            TILECACHE['version'] = version
+            TILECACHE['bytes'] = sum(size for _, size, _ in tile_files(cache / version))
+        else:
+            TILECACHE['bytes'] += added
+        if TILECACHE['bytes'] <= APP.config['TILECACHEBYTES']:
+            return
+        files = tile_files(cache / version)
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= APP.config['TILECACHEBYTES'] * 3 // 4:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+        TILECACHE['bytes'] = total
+
+def get_rollup(table, keys):
+    """return the rows of a rollup table matching the query string as dictionaries
+
+    the filters are a prefix of the table's primary key so this is an index lookup"""
+    where = ["1"]
+    params = []
+    for arg, column in keys.items():
+        value = request.args.get(arg)
+        if value is not None:
+            where.append(f"{column} =?")
+            params.append(int(value) if column == 'Crash_Year' and value.isdigit() else value)
+    result = []
+    try:
+        conn = get_factordb()
+        if conn:
+            rows = conn.execute(f"SELECT * FROM {table} WHERE {' AND '.join(where)};", params)
+            result = [dict(row) for row in rows]
+    except sqlite3.DatabaseError as err:
+        print("Error\n", err)
+    return result
+
+def connect_reader(database):
+    """return a read-only connection to the database, tuned for serving requests"""
+    # a connection is used by one request at a time, but requests run on different threads
+    conn = sqlite3.connect(database, check_same_thread=False, factory=metrics.TimedConnection)
+    conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA mmap_size = {APP.config['SQLITE_MMAPSIZE']};")
+    conn.execute(f"PRAGMA cache_size = {APP.config['SQLITE_CACHESIZE']};")
+    # loads publish in WAL mode, so the reads here never wait for one to finish
+    conn.execute("PRAGMA query_only = ON;")
+    return conn
+
+def connect_attached(factordatabase, mapdatabase):
+    """return a read-only connection with the factor and map databases attached as
+    factor and map, so queries can join the two datasets inside sqlite"""
+    conn = sqlite3.connect(':memory:', check_same_thread=False, factory=metrics.TimedConnection)
+    conn.row_factory = sqlite3.Row
+    for schema, database in (('factor', factordatabase), ('map', mapdatabase)):
+        conn.execute(f"ATTACH DATABASE ? AS {schema};", (database,))
+        conn.execute(f"PRAGMA {schema}.mmap_size = {APP.config['SQLITE_MMAPSIZE']};")
+        conn.execute(f"PRAGMA {schema}.cache_size = {APP.config['SQLITE_CACHESIZE']};")
+    conn.execute("PRAGMA query_only = ON;")
+    return conn
+
+def connect_writer(database):
+    """return a connection for loading data into a shadow database
+
+    nothing reads the shadow until shadow_database() publishes it, so it is written
+    without a journal or syncing and a failed load just throws it away"""
+    conn = sqlite3.connect(database)
+    # a copy of an older live file may be in WAL mode, which cannot go straight to OFF
+    conn.execute("PRAGMA journal_mode = DELETE;")
+    conn.execute("PRAGMA journal_mode = OFF;")
+    conn.execute("PRAGMA synchronous = OFF;")
+    return conn
+
+def file_identity(database):
+    """return the inode of a database file, or a tuple of them for attached databases"""
+    if isinstance(database, tuple):
+        return tuple(file_identity(part) for part in database)
+    try:
+        return os.stat(database).st_ino
+    except FileNotFoundError:
+        return None
+
+def get_db(database):
+    """return the current request's read-only connection to the database
+
+    database can also be a tuple of the factor and map databases, for a connection
+    with both attached.  the connection is taken from the pool the first time the
+    request asks for it and close_db() hands it back when the request ends"""
+    if 'dbconns' not in g:
+        g.dbconns = dict()
+    if database not in g.dbconns:
+        g.dbconns[database] = checkout_db(database)
+    return g.dbconns[database][0]
+
+def checkout_db(database):
+    """take an idle connection to the database from the pool, opening one if there are none
+
+    the first load renames its file into place and a file can be replaced by hand,
+    the inode changing is how the pool knows to close connections to the old file
+    instead of handing them out
+
+        Returns:
+            A tuple of the connection and the inode of the file it was opened on
+    """
+    # stat before connecting, if a swap lands in between the connection is just reopened later
+    inode = file_identity(database)
+    with POOLLOCK:
+        idle = POOL.setdefault(database, Queue(APP.config['POOLSIZE']))
+    while True:
+        try:
+            conn, known = idle.get_nowait()
+        except Empty:
+            break
+        if known == inode:
+            return (conn, inode)
+        conn.close()
+    if isinstance(database, tuple):
+        return (connect_attached(*database), inode)
+    return (connect_reader(database), inode)
+
+def get_store():
+    """return the column store for the map data, reloading it if it has been rebuilt
+
+        Returns:
+            columns.ColumnStore, None if numpy is not installed or it has not been built
+    """
+    storefile = APP.config['COLUMNSTORE']
+    mtime = Path(storefile).stat().st_mtime if isfile(storefile) else None
+    with STORELOCK:
+        if mtime != STORE['mtime']:
+            STORE['store'] = columns.load_store(storefile)
+            STORE['mtime'] = mtime
+        return STORE['store']
+
+def store_version(conn):
+    """return the version of the map data, a hash of the files loaded into the map
+    database.  the column store and the tile cache are keyed on it"""
+    try:
+        rows = [tuple(row) for row in conn.execute("SELECT filename, hash, loaded_at FROM sources;")]
+    except sqlite3.DatabaseError:
+        rows = []
+    return hashlib.sha256(repr(sorted(rows)).encode()).hexdigest()
+
+def store_builder(conn, incremental=False):
+    """return a columns.StoreBuilder for a load of the map data through conn
+
+    an incremental load adds to the saved store, which has to be of the data in the
+    database before the load, so None is returned when it is not.  None as well if
+    numpy is not installed"""
+    if columns.numpy is None:
+        return None
+    schema = DATASETS['map']['schema']
+    # id is the Crash_Ref_Number of the csv
+    names = ['Crash_Ref_Number' if name == 'id' else name for _, name, _, _ in schema]
+    base = None
+    if incremental:
+        base = columns.load_store(APP.config['COLUMNSTORE'])
+        if base is None or base.version != store_version(conn) or set(base.columns) != set(names):
+            print("the column store is not of the current map data, the next full load rebuilds it")
+            return None
+    return columns.StoreBuilder(names, [kind for _, _, kind, _ in schema], base)
+
+def save_store(store, version):
+    """save the column store a map load built, if it built one"""
+    if store is None:
+        return
+    rows = store.save(APP.config['COLUMNSTORE'], version, key='Crash_Ref_Number')
+    print(f"{rows} crashes saved to the column store {APP.config['COLUMNSTORE']}.")
+
 def get_factordb():
     """return a database connection object"""
-    if 'dbf' not in g:
-        g.dbf = sqlite3.connect(
-            APP.config['FACTORDATABASE'],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.dbf.row_factory = sqlite3.Row
-    return g.dbf
+    return get_db(APP.config['FACTORDATABASE'])
 
 def get_mapdb():
     """return a database connection object"""
-    if 'dbf' not in g:
-        g.dbf = sqlite3.connect(
-            APP.config['MAPDATABASE'],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.dbf.row_factory = sqlite3.Row
-    return g.dbf
+    return get_db(APP.config['MAPDATABASE'])
+
+def get_bothdb():
+    """return a database connection with the factor and map databases attached"""
+    return get_db((APP.config['FACTORDATABASE'], APP.config['MAPDATABASE']))
+
+def dataset_version():
+    """return a tuple of the version of the loaded data and when it was last loaded
+
+    the version changes whenever a csv is loaded into either database, cached
+    pages are keyed on it so they are rebuilt after the next load"""
+    rows = []
+    for conn in (get_factordb(), get_mapdb()):
+        try:
+            rows += [tuple(row) for row in conn.execute("SELECT filename, hash, loaded_at FROM sources;")]
+        except sqlite3.DatabaseError:
+            pass
+    tag = hashlib.sha256(repr(sorted(rows)).encode()).hexdigest()
+    loaded = None
+    if rows:
+        loaded = datetime.strptime(max(row[2] for row in rows), '%Y-%m-%d %H:%M:%S')
+        loaded = loaded.replace(tzinfo=timezone.utc)
+    return (tag, loaded)
 
-def close_db():
-    """close the connection to the database"""
-    dbf = g.pop('dbf', None)
+@APP.teardown_appcontext
+def close_db(exception=None):
+    """end any read transaction left open by the request and return its connections to
+    the pool, closing them instead when the pool already has POOLSIZE idle ones"""
+    for database, (conn, inode) in g.pop('dbconns', dict()).items():
+        if conn.in_transaction:
+            conn.rollback()
+        with POOLLOCK:
+            idle = POOL.get(database)
+        try:
+            if idle is None:
+                raise Full
+            idle.put_nowait((conn, inode))
+        except Full:
+            conn.close()
 
-    if dbf is not None:
-        dbf.close()
+@atexit.register
+def close_pool():
+    """close every idle pooled connection when the worker exits"""
+    with POOLLOCK:
+        queues = list(POOL.values())
+        POOL.clear()
+    for idle in queues:
+        while True:
+            try:
+                conn, _ = idle.get_nowait()
+            except Empty:
+                break
+            conn.close()
 
 """-----------------------------------------------------------------------------------------------------------"""
 
-def initdb_factor():
-    """create the database table and populate with default data"""
-    try:
-        conn = sqlite3.connect(FACTORDATABASE)
-        if conn:
-            conn.executescript("""DROP Table IF EXISTS data;
-                                CREATE TABLE data 
-                                (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                                Crash_Year INT, 
-                                Crash_Police_Region TEXT,
-                                Crash_Severity TEXT,
-                                Involving_Drink_Driving TEXT,
-                                Involving_Driver_Speed TEXT,
-                                Involving_Fatigued_Driver TEXT,
-                                Involving_Defective_Vehicle TEXT,
-                                Count_Crashes INT,
-                                Count_Fatality INT,
-                                Count_Hospitalised INT,
-                                Count_Medically_Treated INT,
-                                Count_Minor_Injury INT,
-                                Count_All_Casualties INT);
-                                """)
-            conn.commit()
-    except sqlite3.DatabaseError as err:
-        print("Initialising Database error\n", err)
-    if conn:
-        conn.close()
+def drop_data(conn):
+    """drop data, which is a view over the encoded table now but a table in older databases"""
+    kind = conn.execute("SELECT type FROM sqlite_master WHERE name = 'data';").fetchone()
+    if kind:
+        conn.execute(f"DROP {kind[0].upper()} data;")
+
+def initdb_factor(conn):
+    """create the database tables on the connection and populate with default data"""
+    drop_data(conn)
+    conn.executescript("""DROP Table IF EXISTS encoded;
+                        DROP Table IF EXISTS region;
+                        DROP Table IF EXISTS severity;
+                        DROP Table IF EXISTS quarantine;
+                        DROP Table IF EXISTS search;
+                        DROP Table IF EXISTS rollup_region;
+                        DROP Table IF EXISTS rollup_factor;
+                        CREATE TABLE region
+                        (code INTEGER PRIMARY KEY,
+                        label TEXT UNIQUE NOT NULL);
+                        CREATE TABLE severity
+                        (code INTEGER PRIMARY KEY,
+                        label TEXT UNIQUE NOT NULL);
+                        CREATE TABLE encoded
+                        (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        Crash_Year INT, 
+                        Crash_Police_Region INT,
+                        Crash_Severity INT,
+                        Involving_Drink_Driving INT,
+                        Involving_Driver_Speed INT,
+                        Involving_Fatigued_Driver INT,
+                        Involving_Defective_Vehicle INT,
+                        Count_Crashes INT,
+                        Count_Fatality INT,
+                        Count_Hospitalised INT,
+                        Count_Medically_Treated INT,
+                        Count_Minor_Injury INT,
+                        Count_All_Casualties INT);
+                        CREATE INDEX IF NOT EXISTS severity_idx
+                        ON encoded (Crash_Severity, id);
+                        CREATE INDEX IF NOT EXISTS region_year_idx
+                        ON encoded (Crash_Police_Region, Crash_Year);
+                        CREATE INDEX IF NOT EXISTS severity_year_idx
+                        ON encoded (Crash_Severity, Crash_Year);
+                        CREATE VIEW data AS
+                        SELECT encoded.id AS id,
+                        Crash_Year,
+                        region.label AS Crash_Police_Region,
+                        severity.label AS Crash_Severity,
+                        CASE Involving_Drink_Driving WHEN 1 THEN 'Yes' ELSE 'No' END
+                            AS Involving_Drink_Driving,
+                        CASE Involving_Driver_Speed WHEN 1 THEN 'Yes' ELSE 'No' END
+                            AS Involving_Driver_Speed,
+                        CASE Involving_Fatigued_Driver WHEN 1 THEN 'Yes' ELSE 'No' END
+                            AS Involving_Fatigued_Driver,
+                        CASE Involving_Defective_Vehicle WHEN 1 THEN 'Yes' ELSE 'No' END
+                            AS Involving_Defective_Vehicle,
+                        Count_Crashes,
+                        Count_Fatality,
+                        Count_Hospitalised,
+                        Count_Medically_Treated,
+                        Count_Minor_Injury,
+                        Count_All_Casualties
+                        FROM encoded
+                        JOIN region ON region.code = encoded.Crash_Police_Region
+                        JOIN severity ON severity.code = encoded.Crash_Severity;
+                        CREATE VIRTUAL TABLE IF NOT EXISTS search USING fts5
+                        (Crash_Severity, Crash_Year, Crash_Police_Region,
+                        content='data', content_rowid='id');
+                        CREATE TRIGGER IF NOT EXISTS search_insert AFTER INSERT ON encoded
+                        BEGIN
+                            INSERT INTO search (rowid, Crash_Severity, Crash_Year, Crash_Police_Region)
+                            SELECT id, Crash_Severity, Crash_Year, Crash_Police_Region
+                            FROM data WHERE id = new.id;
+                        END;
+                        CREATE TABLE IF NOT EXISTS rollup_region
+                        (Crash_Year INT,
+                        Crash_Police_Region TEXT,
+                        Crash_Severity TEXT,
+                        Count_Crashes INT,
+                        Count_Fatality INT,
+                        Count_Hospitalised INT,
+                        Count_Medically_Treated INT,
+                        Count_Minor_Injury INT,
+                        Count_All_Casualties INT,
+                        PRIMARY KEY (Crash_Year, Crash_Police_Region, Crash_Severity))
+                        WITHOUT ROWID;
+                        CREATE TABLE IF NOT EXISTS rollup_factor
+                        (Factor TEXT,
+                        Crash_Year INT,
+                        Crash_Police_Region TEXT,
+                        Count_Crashes INT,
+                        Count_Fatality INT,
+                        Count_Hospitalised INT,
+                        Count_Medically_Treated INT,
+                        Count_Minor_Injury INT,
+                        Count_All_Casualties INT,
+                        PRIMARY KEY (Factor, Crash_Year, Crash_Police_Region))
+                        WITHOUT ROWID;
+                        CREATE TABLE IF NOT EXISTS quarantine
+                        (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        filename TEXT,
+                        line INT,
+                        reason TEXT,
+                        row TEXT);
+                        """)
+    conn.commit()
 
-def upload_factor(filename):
-    """upload users from a csv file if the data is valid"""
+def upload_factor(conn, filename, digest=None):
+    """upload factors from a csv file into the database of conn, streaming it in batches
+
+    if digest is the hash of the csv and there is a snapshot of it, the rows are
+    read from the snapshot instead of parsing and validating the csv again
+
+        Returns:
+            A tuple of the rows added and quarantined, None if the upload failed
+    """
     message = None
-    conn = None
+    counts = None
     if isfile(filename):
-        # ouputtuple[0] - True or False
-        # ouputtuple[1] - message for user
-        # ouputtuple[2] - a list of tuples containing the data
-        outputtuple = isvaliddata(filename)
-        message = outputtuple[1]
-        if outputtuple[0]:
-            try:
-                # conn = sqlite3.connect(DATABASE)
-                conn = get_factordb()
-                if conn:
-                    conn.executemany("""INSERT INTO data (
-                                        Crash_Year, 
-                                        Crash_Police_Region,
-                                        Crash_Severity,
-                                        Involving_Drink_Driving,
-                                        Involving_Driver_Speed,
-                                        Involving_Fatigued_Driver,
-                                        Involving_Defective_Vehicle,
-                                        Count_Crashes,
-                                        Count_Fatality,
-                                        Count_Hospitalised,
-                                        Count_Medically_Treated,
-                                        Count_Minor_Injury,
-                                        Count_All_Casualties) VALUES 
-                                        (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);""", outputtuple[2])
-                    conn.commit()
-            except sqlite3.DatabaseError as err:
-                print("Data Upload error\n", err)
-                print(outputtuple[2])
-                message = f"Error occurred uploading {filename}."
+        try:
+            with open(filename, mode='rb') as rawfile:
+                counts = insert_batches(conn,
+                                        get_rows(rawfile, 0, FACTORSCHEMA,
+                                                 APP.config['FACTORSNAPSHOT'], digest),
+                                        filename, 'factor')[:2]
+            build_rollups(conn)
+            message = f"{counts[0]} factors uploaded from {filename}, {counts[1]} rows quarantined."
+        except sqlite3.DatabaseError as err:
+            print("Data Upload error\n", err)
+            message = f"Error occurred uploading {filename}."
+            counts = None
     else:
         message = f"{filename} is not a file"
-    close_db()
     if message:
         print(message)
+    return counts
+
+def build_rollups(conn):
+    """total the factor table by year, region and severity and by contributing factor
+
+    done once at ingest so the stats api is a lookup instead of a scan of the table"""
+    totals = """SUM(Count_Crashes), SUM(Count_Fatality), SUM(Count_Hospitalised),
+                SUM(Count_Medically_Treated), SUM(Count_Minor_Injury), SUM(Count_All_Casualties)"""
+    conn.execute("DELETE FROM rollup_region;")
+    conn.execute(f"""INSERT INTO rollup_region
+                     SELECT Crash_Year, Crash_Police_Region, Crash_Severity, {totals}
+                     FROM data GROUP BY Crash_Year, Crash_Police_Region, Crash_Severity;""")
+    conn.execute("DELETE FROM rollup_factor;")
+    for factor, column in zip(FACTORS, ['Involving_Drink_Driving', 'Involving_Driver_Speed',
+                                        'Involving_Fatigued_Driver', 'Involving_Defective_Vehicle']):
+        conn.execute(f"""INSERT INTO rollup_factor
+                         SELECT ?, Crash_Year, Crash_Police_Region, {totals}
+                         FROM data WHERE {column} = 'Yes'
+                         GROUP BY Crash_Year, Crash_Police_Region;""", (factor,))
+    conn.commit()
 
 """--------------------------------------------------------------------------------------------------------------------------"""
 
-def initdb_map():
-    """create the database table and populate with default data"""
+def outdated_map(conn):
+    """check whether a map database has a layout from before dictionary encoding or
+    the Crash_Hour column, which incremental loads cannot add to"""
+    return bool(conn.execute("""SELECT 1 FROM sqlite_master
+                                 WHERE name = 'data' AND type = 'table';""").fetchone()
+                or (conn.execute("SELECT 1 FROM pragma_table_info('encoded');").fetchone()
+                    and not conn.execute("""SELECT 1 FROM pragma_table_info('encoded')
+                                             WHERE name = 'Crash_Hour';""").fetchone()))
+
+def can_append(database):
+    """check whether an incremental load can add to the live map database, rather
+    than it needing to be loaded from scratch"""
+    if not isfile(database):
+        return False
+    conn = sqlite3.connect(database)
     try:
-        conn = sqlite3.connect(MAPDATABASE)
-        if conn:
-            conn.executescript("""DROP Table IF EXISTS data;
-                                CREATE TABLE data 
-                                (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                                Crash_Severity TEXT,
-                                Crash_Year INT,
-                                Crash_Month INT,
-                                Crash_Day_Of_Week INT,
-                                Loc_Suburb TEXT,
-                                Loc_Post_Code INT,
-                                Loc_Police_Division TEXT,
-                                Loc_Police_District TEXT,
-                                Loc_Police_Region TEXT,
-                                Count_Casualty_Fatality INT,
-                                Count_Casualty_Hospitalised INT,
-                                Count_Casualty_MedicallyTreated INT,
-                                Count_Casualty_MinorInjury INT,
-                                Count_Casualty_Total INT);
-                                """)
-            conn.commit()
-    except sqlite3.DatabaseError as err:
-        print("Initialising Database error\n", err)
-    if conn:
+        return (bool(conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'encoded';").fetchone())
+                and not outdated_map(conn))
+    except sqlite3.DatabaseError:
+        return False
+    finally:
         conn.close()
 
-def upload_map(filename):
-    """upload users from a csv file if the data is valid"""
+def initdb_map(conn, drop=True):
+    """create the database tables on the connection, dropping any existing data
+    unless drop is False
+
+    id is the Crash_Ref_Number from the csv so incremental loads can skip crashes
+    that are already in the table"""
+    # databases from before dictionary encoding or the Crash_Hour column
+    # cannot be added to, so they are rebuilt
+    if not drop and outdated_map(conn):
+        print("the map database is from an older version, reloading it from scratch")
+        drop = True
+    if drop:
+        drop_data(conn)
+        conn.executescript("""DROP Table IF EXISTS encoded;
+                            DROP Table IF EXISTS month;
+                            DROP Table IF EXISTS weekday;
+                            DROP Table IF EXISTS severity;
+                            DROP Table IF EXISTS suburb;
+                            DROP Table IF EXISTS division;
+                            DROP Table IF EXISTS district;
+                            DROP Table IF EXISTS region;
+                            DROP Table IF EXISTS quarantine;
+                            DROP Table IF EXISTS search;
+                            DROP Table IF EXISTS spatial;
+                            DROP Table IF EXISTS watermark;""")
+    conn.executescript("""CREATE TABLE IF NOT EXISTS month
+                        (code INTEGER PRIMARY KEY,
+                        label TEXT UNIQUE NOT NULL);
+                        CREATE TABLE IF NOT EXISTS weekday
+                        (code INTEGER PRIMARY KEY,
+                        label TEXT UNIQUE NOT NULL);
+                        CREATE TABLE IF NOT EXISTS severity
+                        (code INTEGER PRIMARY KEY,
+                        label TEXT UNIQUE NOT NULL);
+                        CREATE TABLE IF NOT EXISTS suburb
+                        (code INTEGER PRIMARY KEY,
+                        label TEXT UNIQUE NOT NULL);
+                        CREATE TABLE IF NOT EXISTS division
+                        (code INTEGER PRIMARY KEY,
+                        label TEXT UNIQUE NOT NULL);
+                        CREATE TABLE IF NOT EXISTS district
+                        (code INTEGER PRIMARY KEY,
+                        label TEXT UNIQUE NOT NULL);
+                        CREATE TABLE IF NOT EXISTS region
+                        (code INTEGER PRIMARY KEY,
+                        label TEXT UNIQUE NOT NULL);
+                        CREATE TABLE IF NOT EXISTS encoded
+                        (id INTEGER PRIMARY KEY,
+                        Crash_Severity INT,
+                        Crash_Year INT,
+                        Crash_Month INT,
+                        Crash_Day_Of_Week INT,
+                        Loc_Suburb INT,
+                        Loc_Post_Code INT,
+                        Loc_Police_Division INT,
+                        Loc_Police_District INT,
+                        Loc_Police_Region INT,
+                        Count_Casualty_Fatality INT,
+                        Count_Casualty_Hospitalised INT,
+                        Count_Casualty_MedicallyTreated INT,
+                        Count_Casualty_MinorInjury INT,
+                        Count_Casualty_Total INT,
+                        Crash_Longitude_GDA94 REAL,
+                        Crash_Latitude_GDA94 REAL,
+                        Crash_Hour INT);
+                        CREATE INDEX IF NOT EXISTS severity_idx
+                        ON encoded (Crash_Severity, id);
+                        -- the time columns on the end of each index let the seasonality
+                        -- queries be answered from the index alone
+                        CREATE INDEX IF NOT EXISTS year_month_idx
+                        ON encoded (Crash_Year, Crash_Month, Crash_Day_Of_Week, Crash_Hour);
+                        CREATE INDEX IF NOT EXISTS region_year_idx
+                        ON encoded (Loc_Police_Region, Crash_Year, Crash_Month,
+                                    Crash_Day_Of_Week, Crash_Hour);
+                        CREATE INDEX IF NOT EXISTS severity_year_idx
+                        ON encoded (Crash_Severity, Crash_Year, Crash_Month,
+                                    Crash_Day_Of_Week, Crash_Hour);
+                        CREATE VIEW IF NOT EXISTS data AS
+                        SELECT encoded.id AS id,
+                        severity.label AS Crash_Severity,
+                        Crash_Year,
+                        month.label AS Crash_Month,
+                        weekday.label AS Crash_Day_Of_Week,
+                        suburb.label AS Loc_Suburb,
+                        Loc_Post_Code,
+                        division.label AS Loc_Police_Division,
+                        district.label AS Loc_Police_District,
+                        region.label AS Loc_Police_Region,
+                        Count_Casualty_Fatality,
+                        Count_Casualty_Hospitalised,
+                        Count_Casualty_MedicallyTreated,
+                        Count_Casualty_MinorInjury,
+                        Count_Casualty_Total,
+                        Crash_Longitude_GDA94,
+                        Crash_Latitude_GDA94,
+                        Crash_Hour
+                        FROM encoded
+                        JOIN severity ON severity.code = encoded.Crash_Severity
+                        JOIN month ON month.code = encoded.Crash_Month
+                        JOIN weekday ON weekday.code = encoded.Crash_Day_Of_Week
+                        LEFT JOIN suburb ON suburb.code = encoded.Loc_Suburb
+                        LEFT JOIN division ON division.code = encoded.Loc_Police_Division
+                        LEFT JOIN district ON district.code = encoded.Loc_Police_District
+                        LEFT JOIN region ON region.code = encoded.Loc_Police_Region;
+                        CREATE VIRTUAL TABLE IF NOT EXISTS search USING fts5
+                        (Crash_Severity, Crash_Year, Loc_Suburb, Loc_Police_Division,
+                        Loc_Police_District, Loc_Police_Region,
+                        content='data', content_rowid='id');
+                        CREATE TRIGGER IF NOT EXISTS search_insert AFTER INSERT ON encoded
+                        BEGIN
+                            INSERT INTO search (rowid, Crash_Severity, Crash_Year, Loc_Suburb,
+                                                Loc_Police_Division, Loc_Police_District,
+                                                Loc_Police_Region)
+                            SELECT id, Crash_Severity, Crash_Year, Loc_Suburb,
+                                   Loc_Police_Division, Loc_Police_District, Loc_Police_Region
+                            FROM data WHERE id = new.id;
+                        END;
+                        CREATE VIRTUAL TABLE IF NOT EXISTS spatial USING rtree
+                        (id, minlon, maxlon, minlat, maxlat);
+                        CREATE TRIGGER IF NOT EXISTS spatial_insert AFTER INSERT ON encoded
+                        WHEN new.Crash_Longitude_GDA94 IS NOT NULL
+                        AND new.Crash_Latitude_GDA94 IS NOT NULL
+                        BEGIN
+                            INSERT INTO spatial (id, minlon, maxlon, minlat, maxlat)
+                            VALUES (new.id, new.Crash_Longitude_GDA94, new.Crash_Longitude_GDA94,
+                                    new.Crash_Latitude_GDA94, new.Crash_Latitude_GDA94);
+                        END;
+                        CREATE TABLE IF NOT EXISTS watermark
+                        (filename TEXT PRIMARY KEY,
+                        max_ref INT,
+                        offset INT,
+                        tail TEXT,
+                        lines INT);
+                        CREATE TABLE IF NOT EXISTS quarantine
+                        (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        filename TEXT,
+                        line INT,
+                        reason TEXT,
+                        row TEXT);
+                        """)
+    # watermarks from before the line count was kept get the column, their files
+    # are read from the start by the next incremental load
+    if not conn.execute("SELECT 1 FROM pragma_table_info('watermark') WHERE name = 'lines';").fetchone():
+        conn.execute("ALTER TABLE watermark ADD COLUMN lines INT;")
+    conn.executemany("INSERT OR IGNORE INTO month (label, code) VALUES (?, ?);", MONTHS.items())
+    conn.executemany("INSERT OR IGNORE INTO weekday (label, code) VALUES (?, ?);", WEEKDAYS.items())
+    conn.commit()
+
+def upload_map(conn, filename, offset=0, line=1, digest=None, commit=True, store=None):
+    """upload crashes from a csv file into the database of conn, skipping crash ref
+    numbers already loaded
+
+    offset is the byte position to start reading from and line the line number
+    before it, incremental loads pass the end of the previous load from
+    incremental_offset() so only the newly appended rows are read.  a full
+    load with the digest of a snapshotted csv reads the snapshot instead.  with
+    commit False nothing is committed, the caller ends the transaction.  the valid
+    rows are also added to store, see insert_batches()
+
+        Returns:
+            A tuple of the rows added and quarantined, None if the upload failed
+    """
     message = None
-    conn = None
+    counts = None
     if isfile(filename):
-        # ouputtuple[0] - True or False
-        # ouputtuple[1] - message for user
-        # ouputtuple[2] - a list of tuples containing the data
-        outputtuple = isvaliddata(filename)
-        message = outputtuple[1]
-        mapData = list()
-        if outputtuple[0]:
-            try:
-                # conn = sqlite3.connect(DATABASE)
-                conn = get_mapdb()
-                if conn:
-                    for row in outputtuple[2]:
-                        getCol = [1,2,3,4,13,15,16,17,18,int(40),int(41),int(42),int(43),int(44)]
-                        newrow = list()
-                        for col in getCol:
-                            newrow.append(row[col])
-                        mapData.append(tuple(newrow))
-
-                    conn.executemany("""INSERT INTO data (
-                                        Crash_Severity,
-                                        Crash_Year,
-                                        Crash_Month,
-                                        Crash_Day_Of_Week,
-                                        Loc_Suburb,
-                                        Loc_Post_Code,
-                                        Loc_Police_Division,
-                                        Loc_Police_District,
-                                        Loc_Police_Region,
-                                        Count_Casualty_Fatality,
-                                        Count_Casualty_Hospitalised,
-                                        Count_Casualty_MedicallyTreated,
-                                        Count_Casualty_MinorInjury,
-                                        Count_Casualty_Total) VALUES 
-                                        (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);""", mapData)
+        try:
+            with open(filename, mode='rb') as rawfile:
+                added, rejected, line = insert_batches(conn,
+                                                       get_rows(rawfile, offset, DATASETS['map']['schema'],
+                                                                APP.config['MAPSNAPSHOT'], digest),
+                                                       filename, 'map', line=line, commit=commit,
+                                                       store=store)
+                counts = (added, rejected)
+                # the snapshot path never reads the file, the load still covers all of it
+                rawfile.seek(0, os.SEEK_END)
+                record_watermark(conn, filename, rawfile.tell(), line)
+                if commit:
                     conn.commit()
-            except sqlite3.DatabaseError as err:
-                print("Data Upload error\n", err)
-                # print(outputtuple[2])
-                message = f"Error occurred uploading {filename}."
+            message = f"{counts[0]} new crashes uploaded from {filename}, {counts[1]} rows quarantined."
+        except sqlite3.DatabaseError as err:
+            print("Data Upload error\n", err)
+            message = f"Error occurred uploading {filename}."
+            counts = None
     else:
         message = f"{filename} is not a file"
-    close_db()
     if message:
         print(message)
+    return counts
 
+def tail_hash(filename, offset):
+    """return the sha256 of the block of the file just before offset"""
+    with open(filename, mode='rb') as datafile:
+        datafile.seek(max(0, offset - TAILSIZE))
+        return hashlib.sha256(datafile.read(min(offset, TAILSIZE))).hexdigest()
 
-def isvaliddata(file):
-    """check whether data in csv file is valid for the database
+def record_watermark(conn, filename, offset, lines):
+    """remember the highest crash ref number and where in the file the load stopped,
+    offset is the size of the file read and lines the number of lines in it"""
+    conn.execute("""INSERT OR REPLACE INTO watermark (filename, max_ref, offset, tail, lines)
+                    VALUES (?, (SELECT MAX(id) FROM encoded), ?, ?, ?);""",
+                 (Path(filename).name, offset, tail_hash(filename, offset), lines))
+
+def incremental_offset(conn, filename):
+    """return where an incremental load of the file into the database of conn can
+    resume from
+
+    this is only safe if the file has been appended to, so the bytes before the
+    recorded offset must still end in a newline and hash the same as last time,
+    otherwise the whole file is streamed.  only the last TAILSIZE bytes are read,
+    so finding what was appended does not cost the size of the file
 
         Returns:
-            A tuple.  The tuple contains three elements
-                [0] - Boolean, True if data is valid, False if not
-                [1] - String, Message for user
-                [2] - list of tuples containing the data from csv file
-                [3] - map data
+            A tuple.  The tuple contains two elements
+                [0] - Integer, the byte offset to read from, 0 for the whole file
+                [1] - Integer, the line number of the line before it
+    """
+    try:
+        known = conn.execute("SELECT offset, tail, lines FROM watermark WHERE filename =?;",
+                             (Path(filename).name,)).fetchone()
+    except sqlite3.DatabaseError:
+        known = None
+    if not known or not known[0] or not known[2] or Path(filename).stat().st_size < known[0]:
+        return (0, 1)
+    with open(filename, mode='rb') as datafile:
+        datafile.seek(known[0] - 1)
+        if datafile.read(1) != b'\n':
+            return (0, 1)
+    if tail_hash(filename, known[0]) != known[1]:
+        return (0, 1)
+    return (known[0], known[2])
+
+def get_rows(rawfile, offset, schema, folder, digest):
+    """return the rows for insert_batches(), from the snapshot in folder if it was
+    made from the csv with hash digest, otherwise by validating the csv"""
+    names = [name for _, name, _, _ in schema]
+    kinds = [kind for _, _, kind, _ in schema]
+    if offset == 0 and digest and snapshot.matches(folder, digest, names, kinds):
+        print(f"reading snapshot {folder}")
+        return snapshot.read_snapshot(folder, digest)
+    return isvaliddata(read_csv(rawfile, offset), schema)
+
+def read_csv(rawfile, offset=0):
+    """yield the rows of a csv file one at a time, skipping the header
+
+    rawfile is opened in binary mode so incremental loads can seek to a byte
+    offset, rawfile.tell() is the end of the data once the rows run out.  bytes
+    that are not utf8 come through as surrogates for isvaliddata() to quarantine
+    the row, rather than stopping the whole load"""
+    rawfile.seek(offset)
+    textfile = io.TextIOWrapper(rawfile, encoding='utf8', errors='surrogateescape', newline='')
+    csvdata = csv.reader(textfile)
+    if offset == 0:
+        next(csvdata, None)
+    try:
+        yield from csvdata
+    finally:
+        # stop the wrapper closing rawfile when it is garbage collected, a reader
+        # that stopped early may have closed rawfile before this generator
+        if not rawfile.closed:
+            textfile.detach()
+
+def convert(name, kind, nullable, value):
+    """convert a csv value to the type of its column
+
+        Returns:
+            A tuple.  The tuple contains two elements
+                [0] - the converted value, None if it is null
+                [1] - String, reason the value is not valid, None if it is
+    """
+    if nullable and value in NULLS:
+        return (None, None)
+    if value == '':
+        return (None, f"{name} is missing")
+    if kind in (int, float):
+        try:
+            number = kind(value)
+        except ValueError:
+            return (None, f"{name} is not a {'whole ' if kind is int else ''}number: {value!r}")
+        if number < 0 and name.startswith('Count_'):
+            return (None, f"{name} is negative: {value!r}")
+        if name == 'Crash_Hour' and not 0 <= number <= 23:
+            return (None, f"{name} is not an hour of the day: {value!r}")
+        return (number, None)
+    if isinstance(kind, dict):
+        if value not in kind:
+            return (None, f"{name} is not one of {list(kind)}: {value!r}")
+        return (kind[value], None)
+    if isinstance(kind, set) and value not in kind:
+        return (None, f"{name} is not one of {sorted(kind)}: {value!r}")
+    return (value, None)
+
+def isvaliddata(rows, schema):
+    """check whether each csv row is valid for the database
+
+    this is a generator so validation happens in the same pass as the insert
+
+        Yields:
+            A tuple for each row.  The tuple contains three elements
+                [0] - Boolean, True if the row is valid, False if not
+                [1] - String, reason the row is not valid, None if it is
+                [2] - tuple of the converted values, or the raw row if not valid
     """
-    with open(file, mode='r', encoding='utf8') as csvfile:
-        csvdata = csv.reader(csvfile)
+    width = max(col for col, _, _, _ in schema) + 1
+    for row in rows:
+        try:
+            "".join(row).encode('utf8')
+        except UnicodeEncodeError:
+            # read_csv() let the bad bytes through as surrogates, which sqlite cannot store
+            yield (False, "row is not valid utf8",
+                   [value.encode('utf8', 'surrogateescape').decode('utf8', 'replace') for value in row])
+            continue
+        if len(row) < width:
+            yield (False, f"expected at least {width} columns, found {len(row)}", row)
+            continue
         data = list()
-        return (True, "short cut solution", list(csvdata))
-        message = "The data is not valid:\n"
-        valid = True
-        for num, row in enumerate(csvdata):
-            if num == 0:
-                continue
-            if not row[0].isalpha():
-                message += f"row {num} - {row[0]}\n"
-                valid = False
-            elif valid:
-                data.append(tuple([row[0]]))
+        reasons = list()
+        for col, name, kind, nullable in schema:
+            value, reason = convert(name, kind, nullable, row[col])
+            if reason:
+                reasons.append(reason)
+            data.append(value)
+        if reasons:
+            yield (False, "; ".join(reasons), row)
+        else:
+            yield (True, None, tuple(data))
+
+def split_batch(batch, filename, line):
+    """split a batch from isvaliddata() into rows for the table and rows for quarantine
+
+        Returns:
+            A tuple.  The tuple contains three elements
+                [0] - list of the valid rows
+                [1] - list of quarantine rows (filename, line, reason, row)
+                [2] - Integer, the line number of the last row in the batch
+    """
+    good = list()
+    bad = list()
+    for valid, reason, data in batch:
+        line += 1
         if valid:
-            message = "The data is valid."
+            good.append(data)
+        else:
+            bad.append((Path(filename).name, line, reason, json.dumps(data)))
+    return (good, bad, line)
+
+def encode_batch(conn, dataset, rows):
+    """replace the categorical values in a batch of valid rows with their codes, and
+    leave out the columns that are only validated for the column store
+
+    labels not seen before are added to their lookup table first.  this keeps the
+    repeated text out of the encoded table, the data view joins it back in
+
+        Returns:
+            A list of the rows with codes in place of the categorical values
+    """
+    names = [name for _, name, _, _ in DATASETS[dataset]['table']]
+    rows = [list(row[:len(names)]) for row in rows]
+    for column, table in DATASETS[dataset]['lookups'].items():
+        col = names.index(column)
+        if table is None:
+            for row in rows:
+                row[col] = int(row[col] == 'Yes')
+            continue
+        labels = {row[col] for row in rows if row[col] is not None}
+        conn.executemany(f"INSERT OR IGNORE INTO {table} (label) VALUES (?);",
+                         [(label,) for label in labels])
+        codes = dict(conn.execute(f"SELECT label, code FROM {table};"))
+        for row in rows:
+            if row[col] is not None:
+                row[col] = codes[row[col]]
+    return rows
+
+def write_batch(conn, dataset, good, bad, commit=True):
+    """insert a batch of valid and quarantined rows as one transaction, or as part of
+    the caller's transaction if commit is False
+
+        Returns:
+            Integer, the number of rows added to the table
+    """
+    # rowcount leaves out rows ignored as duplicates and rows added by triggers
+    added = conn.executemany(DATASETS[dataset]['insert'], encode_batch(conn, dataset, good)).rowcount
+    if bad:
+        conn.executemany("""INSERT INTO quarantine (filename, line, reason, row)
+                            VALUES (?, ?, ?, ?);""", bad)
+    if commit:
+        conn.commit()
+    return added
+
+def batch_rows(filename):
+    """return the rows per batch for a csv file
+
+    a file profiled by flask data profile gets batches of about BATCHBYTES of csv,
+    so files with long rows do not hold more in memory than ones with short rows"""
+    profile = None
+    if APP.config['BATCHBYTES']:
+        profile = dataprofile.load_profile(filename, APP.config['PROFILESTATS'])
+    if not profile or not profile['bytes_per_row']:
+        return APP.config['BATCHSIZE']
+    return max(100, min(int(APP.config['BATCHBYTES'] / profile['bytes_per_row']), 100000))
+
+def insert_batches(conn, rows, filename, dataset, batchsize=None, line=1, commit=True, store=None):
+    """insert valid rows a batch at a time, committing each batch as its own transaction
+    unless commit is False
+
+    rows come from isvaliddata(), rows that are not valid go into the quarantine
+    table with the reason they were rejected.  only one batch is held at once so
+    memory use does not grow with the file.  line is the line number of the line
+    before the first row, see incremental_offset().  the valid rows of each batch
+    are also added to store, a columns.StoreBuilder, if there is one.  the counts
+    are added to the ingest metrics of dataset
+
+        Returns:
+            A tuple.  The tuple contains three elements
+                [0] - Integer, the number of rows added to the table
+                [1] - Integer, the number of rows quarantined
+                [2] - Integer, the line number of the last row
+    """
+    batchsize = batchsize or batch_rows(filename)
+    started = time.perf_counter()
+    added = 0
+    rejected = 0
+    batches = 0
+    while True:
+        batch = list(islice(rows, batchsize))
+        if not batch:
+            break
+        good, bad, line = split_batch(batch, filename, line)
+        added += write_batch(conn, dataset, good, bad, commit)
+        if store is not None:
+            store.add(good)
+        rejected += len(bad)
+        batches += 1
+    metrics.save_ingest(APP.config['INGESTMETRICS'], dataset, added, rejected, batches,
+                        time.perf_counter() - started)
+    return (added, rejected, line)
+
+
+""" ----------------------------------- Ingestion ----------------------------------- """
+def file_hash(filename):
+    """return the sha256 of a file, read in blocks so large csv files are fine"""
+    digest = hashlib.sha256()
+    with open(filename, mode='rb') as datafile:
+        for block in iter(lambda: datafile.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def initdb_sources(conn):
+    """create the table that records which csv files have been loaded"""
+    conn.execute("""CREATE TABLE IF NOT EXISTS sources
+                    (filename TEXT PRIMARY KEY,
+                    hash TEXT,
+                    mtime REAL,
+                    loaded_at TEXT DEFAULT CURRENT_TIMESTAMP);""")
+
+def source_changed(database, filename):
+    """check a csv file against the last load recorded in the database
+
+        Returns:
+            A tuple.  The tuple contains three elements
+                [0] - Boolean, True if the file needs to be loaded
+                [1] - String, sha256 of the file (None if the mtime matched)
+                [2] - Float, modification time of the file
+    """
+    mtime = Path(filename).stat().st_mtime
+    conn = sqlite3.connect(database)
+    try:
+        initdb_sources(conn)
+        known = conn.execute("SELECT hash, mtime FROM sources WHERE filename =?;",
+                             (Path(filename).name,)).fetchone()
+        if known and known[1] == mtime:
+            return (False, None, mtime)
+        digest = file_hash(filename)
+        if known and known[0] == digest:
+            # touched but not edited, remember the new mtime so we skip hashing next time
+            conn.execute("UPDATE sources SET mtime =? WHERE filename =?;",
+                         (mtime, Path(filename).name))
+            conn.commit()
+            return (False, digest, mtime)
+        return (True, digest, mtime)
+    finally:
+        conn.close()
+
+def record_source(conn, filename, digest, mtime):
+    """remember the hash and mtime of a csv file that has just been loaded, as part of
+    the load's transaction on conn"""
+    initdb_sources(conn)
+    conn.execute("""INSERT OR REPLACE INTO sources (filename, hash, mtime)
+                    VALUES (?, ?, ?);""", (Path(filename).name, digest, mtime))
+
+def remove_database(database):
+    """delete a database file along with any journal or WAL files next to it"""
+    for suffix in ('', '-journal', '-wal', '-shm'):
+        Path(database + suffix).unlink(missing_ok=True)
+
+def publish_database(shadow, live):
+    """copy a finished shadow database into the live one, both in WAL mode
+
+    readers of a WAL database keep reading the old pages while the copy is written
+    and see all of the new data at their next read, so they never get database is
+    locked.  renaming the shadow over the live file would leave the readers still
+    open on the old file sharing its -wal and -shm with the new one, and the last of
+    them to close would checkpoint into the old file and delete the new one's WAL"""
+    conn = sqlite3.connect(shadow)
+    # sqlite_stat1 gives the planner the real number of rows per index value
+    conn.execute("ANALYZE;")
+    # WAL is kept in the file header, the copy and everything reading it get it too
+    conn.execute("PRAGMA journal_mode = WAL;")
+    conn.close()
+    if not isfile(live):
+        # nothing can have a file that is not there open, so it is just renamed into place
+        with open(shadow, mode='rb+') as datafile:
+            os.fsync(datafile.fileno())
+        os.replace(shadow, live)
+        return
+    source = sqlite3.connect(shadow)
+    target = sqlite3.connect(live, timeout=30)
+    try:
+        target.execute("PRAGMA journal_mode = WAL;")
+        source.backup(target)
+        # move what it can of the copy out of the WAL without waiting on readers
+        target.execute("PRAGMA wal_checkpoint(PASSIVE);")
+    finally:
+        target.close()
+        source.close()
+    remove_database(shadow)
+
+@contextmanager
+def shadow_database(live):
+    """load into a new copy of the database live and swap it in when the load is done
+
+    the block gets a connect_writer() connection to a shadow file next to live, the
+    load functions write through it while the web server keeps reading the live
+    file.  if the block finishes the load is committed and publish_database() copies
+    the shadow into the live file in one transaction, the next request sees the new
+    data and the new dataset version.  if the block raises or the shadow cannot be
+    published it is deleted and the old data is still served, database errors are
+    raised as RuntimeError like the other load failures"""
+    shadow = live + '.loading'
+    remove_database(shadow)
+    conn = connect_writer(shadow)
+    try:
+        yield conn
+        conn.commit()
+    except sqlite3.DatabaseError as err:
+        conn.close()
+        remove_database(shadow)
+        raise RuntimeError(f"the new data was not loaded into {live}, the last version is "
+                           f"still being served\n{err}") from err
+    except BaseException:
+        conn.close()
+        remove_database(shadow)
+        raise
+    conn.close()
+    try:
+        publish_database(shadow, live)
+    except (OSError, sqlite3.DatabaseError) as err:
+        remove_database(shadow)
+        raise RuntimeError(f"the new data could not replace {live}, the last version is "
+                           f"still being served\n{err}") from err
+
+@contextmanager
+def live_transaction(database):
+    """add to the live database in one transaction, for incremental loads
+
+    copying the live file to a shadow would make every incremental load cost the
+    whole database, so the new rows are written straight into it instead.  the
+    block gets the one connection to write through and passes commit=False to the
+    load functions, so readers keep seeing the old rows until the block ends and
+    then all of the new ones.  if the block raises the transaction is rolled back"""
+    conn = sqlite3.connect(database, timeout=30)
+    conn.execute("PRAGMA journal_mode = WAL;")
+    conn.execute("PRAGMA synchronous = NORMAL;")
+    try:
+        yield conn
+        conn.commit()
+    except sqlite3.DatabaseError as err:
+        conn.rollback()
+        raise RuntimeError(f"the new rows were not added to {database}, the last version is "
+                           f"still being served\n{err}") from err
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def load_factor(filename, force=False):
+    """load the factor csv once, only reloading when its contents change"""
+    if not isfile(filename):
+        print(f"{filename} is not a file")
+        return False
+    changed, digest, mtime = source_changed(APP.config['FACTORDATABASE'], filename)
+    if not (changed or force):
+        print(f"{filename} is unchanged, skipping")
+        return False
+    digest = digest or file_hash(filename)
+    try:
+        with shadow_database(APP.config['FACTORDATABASE']) as conn:
+            initdb_factor(conn)
+            if upload_factor(conn, filename, digest) is None:
+                raise RuntimeError(f"{filename} was not loaded, the last version is still being served")
+            record_source(conn, filename, digest, mtime)
+    except RuntimeError as err:
+        print(err)
+        return False
+    return True
+
+def load_map(filename, force=False, incremental=False):
+    """load the map csv once, only reloading when its contents change
+
+    an incremental load keeps the crashes already in the table and only adds
+    the ones with a new Crash_Ref_Number"""
+    if not isfile(filename):
+        print(f"{filename} is not a file")
+        return False
+    database = APP.config['MAPDATABASE']
+    if incremental and not can_append(database):
+        print("the map database is missing or from an older version, reloading it from scratch")
+        incremental = False
+    if incremental:
+        # the watermark says what was appended, so the file is not hashed as a whole
+        digest, mtime = None, Path(filename).stat().st_mtime
+    else:
+        changed, digest, mtime = source_changed(database, filename)
+        if not (changed or force):
+            print(f"{filename} is unchanged, skipping")
+            return False
+        digest = digest or file_hash(filename)
+    try:
+        loading = live_transaction(database) if incremental else shadow_database(database)
+        with loading as conn:
+            offset, line = incremental_offset(conn, filename) if incremental else (0, 1)
+            if incremental and offset == Path(filename).stat().st_size and not force:
+                print(f"{filename} has no new rows, skipping")
+                return False
+            store = store_builder(conn, incremental)
+            initdb_map(conn, drop=not incremental)
+            if upload_map(conn, filename, offset, line, digest, not incremental, store) is None:
+                raise RuntimeError(f"{filename} was not loaded, the last version is still being served")
+            record_source(conn, filename, digest, mtime)
+            version = store_version(conn)
+    except RuntimeError as err:
+        print(err)
+        return False
+    save_store(store, version)
+    return True
+
+def csv_dataset(filename):
+    """return 'factor' or 'map' depending on the header of a csv file, None if it is neither"""
+    # only the header has to be text here, read_csv() quarantines rows with bad bytes
+    with open(filename, mode='r', encoding='utf8', errors='replace', newline='') as csvfile:
+        header = next(csv.reader(csvfile), [])
+    for name, dataset in DATASETS.items():
+        if header[:1] == [dataset['header']]:
+            return name
+    return None
+
+def validate_file(filename, dataset, start, batchsize, queue, stop):
+    """parse and validate one csv in a worker process, sending the batches to the
+    writer through queue so only the writer touches the database.  start is the
+    (byte offset, line number) to read from, see incremental_offset().  the worker
+    gives up when the writer sets stop"""
+    offset, line = start
+    try:
+        with open(filename, mode='rb') as rawfile:
+            rows = isvaliddata(read_csv(rawfile, offset), DATASETS[dataset]['schema'])
+            while not stop.is_set():
+                batch = list(islice(rows, batchsize))
+                if not batch:
+                    queue.put(('done', filename, rawfile.tell(), line))
+                    break
+                good, bad, line = split_batch(batch, filename, line)
+                queue.put(('rows', filename, good, bad))
+    except Exception as err:
+        # anything going wrong has to reach the writer or it waits for this file forever
+        queue.put(('error', filename, f"{type(err).__name__}: {err}"))
+
+def stop_workers(jobs, queue, stop):
+    """tell the workers to stop and empty the queue until they have, a worker blocked
+    putting a batch on the full queue would otherwise never finish"""
+    stop.set()
+    for job in jobs:
+        job.cancel()
+    while not all(job.done() for job in jobs):
+        try:
+            queue.get(timeout=0.1)
+        except Empty:
+            pass
+
+def parallel_upload(conn, filenames, dataset, offsets, workers=None, commit=True, store=None):
+    """validate the csv files in a process pool and insert their rows through conn
+    from this process
+
+    offsets maps a filename to the (byte offset, line number) to start reading it
+    from.  the queue between them is bounded so workers wait for the writer instead of
+    piling parsed rows up in memory.  if the writer fails the workers are stopped and
+    the error is raised.  with commit False nothing is committed, the caller ends
+    the transaction.  the valid rows are also added to store, see insert_batches()
+
+        Returns:
+            A dictionary of filename to a list of [rows added, rows quarantined, error]
+    """
+    results = {filename: [0, 0, None] for filename in filenames}
+    started = time.perf_counter()
+    workers = workers or os.cpu_count() or 1
+    with multiprocessing.Manager() as manager:
+        queue = manager.Queue(maxsize=workers * 4)
+        stop = manager.Event()
+        with ProcessPoolExecutor(workers) as pool:
+            jobs = [pool.submit(validate_file, filename, dataset, offsets.get(filename, (0, 1)),
+                                batch_rows(filename), queue, stop) for filename in filenames]
+            try:
+                batches = write_queue(conn, dataset, queue, jobs, results, commit, store)
+            except BaseException:
+                stop_workers(jobs, queue, stop)
+                raise
+    if dataset == 'factor':
+        build_rollups(conn)
+    print()
+    metrics.save_ingest(APP.config['INGESTMETRICS'], dataset, sum(result[0] for result in results.values()),
+                        sum(result[1] for result in results.values()), batches,
+                        time.perf_counter() - started)
+    return results
+
+def write_queue(conn, dataset, queue, jobs, results, commit=True, store=None):
+    """write the batches the workers put on queue until every file is done
+
+    results is the dictionary parallel_upload() returns, it is updated as the
+    batches are written.  each batch is committed unless commit is False, and its
+    valid rows are added to store if there is one
+
+        Returns:
+            Integer, the number of batches written
+    """
+    filenames = list(results)
+    pending = set(filenames)
+    batches = 0
+    while pending:
+        try:
+            message = queue.get(timeout=1)
+        except Empty:
+            if all(job.done() for job in jobs) and queue.empty():
+                for filename in pending:
+                    results[filename][2] = "worker stopped without finishing"
+                break
+            continue
+        kind, filename = message[0], message[1]
+        if kind == 'rows':
+            results[filename][0] += write_batch(conn, dataset, message[2], message[3], commit)
+            if store is not None:
+                store.add(message[2])
+            results[filename][1] += len(message[3])
+            batches += 1
+            print(f"{len(filenames) - len(pending)}/{len(filenames)} files done, "
+                  f"{sum(result[0] for result in results.values())} rows written", end='\r')
         else:
-            data = None
-        return (valid, message, data)
+            if kind == 'error':
+                results[filename][2] = message[2]
+            elif dataset == 'map':
+                record_watermark(conn, filename, message[2], message[3])
+                if commit:
+                    conn.commit()
+            pending.discard(filename)
+    return batches
+
+def load_files(patterns, force=False, incremental=False, workers=None):
+    """load every csv matching the glob patterns, in parallel
+
+    each file is sent to the factor or map database by its header.  if any file of a
+    dataset has changed the dataset is rebuilt from all of its files, except that an
+    incremental map load only adds what was appended to each file to the crashes
+    already loaded"""
+    filenames = sorted({filename for pattern in patterns for filename in glob.glob(pattern)})
+    # each dataset is loaded into a shadow database and only swapped in if every file loads
+    datasets = {name: [] for name in DATASETS}
+    for filename in filenames:
+        dataset = csv_dataset(filename)
+        if dataset is None:
+            print(f"{filename} is not a factor or map csv, skipping")
+        else:
+            datasets[dataset].append(filename)
+    for dataset, files in datasets.items():
+        if not files:
+            continue
+        database = APP.config[DATASETS[dataset]['database']]
+        append = dataset == 'map' and incremental and can_append(database)
+        if dataset == 'map' and incremental and not append:
+            print("the map database is missing or from an older version, reloading it from scratch")
+        if append:
+            # the watermarks say what was appended, so the files are not hashed as a whole
+            checks = {filename: (True, None, Path(filename).stat().st_mtime) for filename in files}
+        else:
+            checks = {filename: source_changed(database, filename) for filename in files}
+        changed = [filename for filename in files if checks[filename][0] or force]
+        if not changed:
+            print(f"{len(files)} {dataset} files are unchanged, skipping")
+            continue
+        offsets = dict()
+        loading = files
+        store = None
+        try:
+            with live_transaction(database) if append else shadow_database(database) as conn:
+                if append:
+                    # an incremental load only reads the files that have grown
+                    offsets = {filename: incremental_offset(conn, filename) for filename in files}
+                    loading = [filename for filename in files
+                               if offsets[filename][0] < Path(filename).stat().st_size or force]
+                    if not loading:
+                        print(f"{len(files)} {dataset} files have no new rows, skipping")
+                        continue
+                    initdb_map(conn, drop=False)
+                elif dataset == 'map':
+                    initdb_map(conn)
+                else:
+                    initdb_factor(conn)
+                if dataset == 'map':
+                    store = store_builder(conn, append)
+                results = parallel_upload(conn, loading, dataset, offsets, workers, not append, store)
+                for filename, (added, rejected, error) in results.items():
+                    if error:
+                        print(f"{filename}: failed, {error}")
+                    else:
+                        print(f"{filename}: {added} rows uploaded, {rejected} rows quarantined.")
+                if any(error for _, _, error in results.values()):
+                    raise RuntimeError(f"the {dataset} files were not loaded, "
+                                       "the last version is still being served")
+                for filename in loading:
+                    _, digest, mtime = checks[filename]
+                    if not (digest or append):
+                        digest = file_hash(filename)
+                    record_source(conn, filename, digest, mtime)
+                version = store_version(conn)
+        except RuntimeError as err:
+            print(err)
+            continue
+        save_store(store, version)
+
+def snapshot_csv(filename, schema, folder):
+    """write the validated rows of a csv file to a snapshot, with the rows that fail
+    validation and why so loads from it quarantine them too"""
+    if not isfile(filename):
+        print(f"{filename} is not a file")
+        return
+    with open(filename, mode='rb') as rawfile:
+        count, rejected = snapshot.write_snapshot(folder, [name for _, name, _, _ in schema],
+                                                  [kind for _, _, kind, _ in schema],
+                                                  isvaliddata(read_csv(rawfile), schema),
+                                                  file_hash(filename), APP.config['BATCHSIZE'])
+    print(f"{count} rows from {filename} saved to the snapshot {folder}, {rejected} rows rejected.")
+
+@DATA_CLI.command('snapshot')
+def snapshot_data():
+    """save the validated csv files as binary snapshots that later loads read instead
+
+    this saves parsing and validating the csv, the rows still have to be inserted
+    so a load from a snapshot takes about four fifths of the time"""
+    snapshot_csv(FACTORCSV + '.csv', FACTORSCHEMA, APP.config['FACTORSNAPSHOT'])
+    snapshot_csv(MAPCSV + '.csv', DATASETS['map']['schema'], APP.config['MAPSNAPSHOT'])
+
+def first_id(database):
+    """return the smallest id in a database, 1 if it is empty or missing"""
+    conn = connect_reader(database)
+    try:
+        row = conn.execute("SELECT MIN(id) FROM data;").fetchone()
+    except sqlite3.DatabaseError:
+        row = None
+    conn.close()
+    return row[0] if row and row[0] is not None else 1
+
+def print_plan(conn, sql, params):
+    """print the query plan sqlite picks for a statement as an indented tree"""
+    depth = {0: 0}
+    for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params):
+        depth[row[0]] = depth.get(row[1], 0) + 1
+        print("    " + "  " * depth[row[0]] + row[3])
+
+@DATA_CLI.command('explain')
+def explain_data():
+    """show the query plan of every query the pages and apis run"""
+    ids = {'factor': first_id(APP.config['FACTORDATABASE']), 'crash': first_id(APP.config['MAPDATABASE'])}
+    client = APP.test_client()
+    seen = set()
+    for url in EXPLAINURLS:
+        url = url.format(**ids)
+        RESPONSECACHE.clear()
+        metrics.CAPTURE = []
+        try:
+            status = client.get(url).status_code
+            statements = metrics.CAPTURE
+        finally:
+            metrics.CAPTURE = None
+        print(f"{url} ({status})")
+        for conn, sql, params in statements:
+            text = " ".join(sql.split())
+            if text in seen or text.startswith(("PRAGMA", "ATTACH")):
+                continue
+            seen.add(text)
+            print(f"  {text}")
+            try:
+                print_plan(conn, sql, params)
+            except sqlite3.DatabaseError as err:
+                print(f"    cannot explain: {err}")
+    close_pool()
+
+def print_index_stats(database, profile):
+    """print the estimated rows per value of the leading column of each index of a
+    database, from the profile of a csv that would be loaded into it"""
+    conn = connect_reader(database)
+    try:
+        indexes = [(row[1], conn.execute(f"PRAGMA index_info({row[1]});").fetchall())
+                   for row in conn.execute("PRAGMA index_list(encoded);")]
+    except sqlite3.DatabaseError:
+        indexes = []
+    conn.close()
+    for name, info in sorted(indexes):
+        if not info or info[0][2] not in profile['columns']:
+            continue
+        column = profile['columns'][info[0][2]]
+        distinct = max(column['distinct'], 1)
+        print(f"  {name} on {', '.join(row[2] for row in info)}: {distinct} values of "
+              f"{info[0][2]}, about {profile['rows'] // distinct} rows each")
+
+@DATA_CLI.command('profile')
+@click.argument('filename')
+def profile_data(filename):
+    """read a csv file once and report the statistics of the columns a load uses, every
+    column if it is not a crash data csv
+
+    the statistics are saved to PROFILESTATS, loads of the file use them to size
+    their batches until it changes"""
+    if not isfile(filename):
+        print(f"{filename} is not a file")
+        return
+    dataset = csv_dataset(filename)
+    coordinates = ('Crash_Longitude_GDA94', 'Crash_Latitude_GDA94') if dataset == 'map' else None
+    # only the columns a load reads, which are all the indexes are on
+    wanted = sorted(index for index, _, _, _ in DATASETS[dataset]['schema']) if dataset else None
+    profile = dataprofile.profile_csv(filename, NULLS, coordinates, QLDBOUNDS, wanted)
+    print(dataprofile.format_report(profile))
+    target = dataprofile.save_profile(profile, APP.config['PROFILESTATS'])
+    if dataset:
+        print(f"{dataset} csv, loads will use batches of {batch_rows(filename)} rows")
+        print_index_stats(APP.config[DATASETS[dataset]['database']], profile)
+    print(f"statistics saved to {target}")
+
+@DATA_CLI.command('load')
+@click.option('--force', is_flag=True, help="reload the csv files even if they have not changed")
+@click.option('--incremental', is_flag=True, help="only add crashes not already in the map database")
+@click.option('--batch-size', type=int, default=None, help="rows inserted per transaction")
+@click.option('--workers', type=int, default=None, help="processes validating csv files, one per cpu by default")
+@click.argument('patterns', nargs=-1)
+def load_data(force, incremental, batch_size, workers, patterns):
+    """load the factor and map csv files into their databases
+
+    with PATTERNS, every csv file matching the glob patterns is loaded in parallel
+    instead of the two default files"""
+    if batch_size:
+        APP.config['BATCHSIZE'] = batch_size
+        APP.config['BATCHBYTES'] = None
+    if patterns:
+        load_files(patterns, force, incremental, workers)
+        return
+    load_factor(FACTORCSV + '.csv', force)
+    load_map(MAPCSV + '.csv', force, incremental)
 
 
 APP.cli.add_command(DATA_CLI)
@@ -0,0 +1,228 @@
+"""Benchmarks for loading the csv files and serving the list and detail pages
+
+runs offline with the flask test client against synthetic copies of the csv files
+scaled up from the ones in data/, for example
+
+    python bench.py --scale 10 --scale 100 > ../bench_output.txt
+
+each scale runs in its own process so the peak RSS reported is for that scale only.
+keep the output from before a change and compare, or save it with --json"""
+import csv
+import json
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+import click
+import app
+
+
+FACTORCSV = Path(__file__).parent / 'data' / 'crashData-CSV.csv'
+MAPCSV = Path(__file__).parent / 'data' / 'mapData-CSV.csv'
+# map csv columns jittered so the copies are not all on top of each other
+LONCOL = 8
+LATCOL = 9
+
+
+def generate(source, target, scale, idcol=None, seed=1):
+    """write scale copies of the rows of source to target
+
+    idcol is the column holding a unique id, each copy gets its own ids so
+    nothing is ignored as a duplicate.  the coordinates of the map rows are moved
+    by up to about 1km so spatial queries see a realistic spread
+
+        Returns:
+            Integer, the number of rows written
+    """
+    rand = random.Random(seed)
+    with open(source, mode='r', encoding='utf8', newline='') as csvfile:
+        rows = list(csv.reader(csvfile))
+    header, rows = rows[0], rows[1:]
+    step = 0
+    if idcol is not None:
+        step = max(int(row[idcol]) for row in rows if row[idcol].isdigit()) + 1
+    count = 0
+    with open(target, mode='w', encoding='utf8', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(header)
+        for copy in range(scale):
+            for row in rows:
+                if copy and idcol is not None:
+                    row = list(row)
+                    if row[idcol].isdigit():
+                        row[idcol] = str(int(row[idcol]) + copy * step)
+                    for col in (LONCOL, LATCOL):
+                        try:
+                            row[col] = f"{float(row[col]) + rand.uniform(-0.01, 0.01):.6f}"
+                        except ValueError:
+                            pass
+                writer.writerow(row)
+                count += 1
+    return count
+
+
+def peak_rss():
+    """return the peak resident memory of this process in MB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports KiB, macOS bytes
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def percentile(times, fraction):
+    """return the value below which fraction of the sorted times fall"""
+    return times[min(len(times) - 1, int(len(times) * fraction))]
+
+
+def time_rows(name, rows, func):
+    """time func, which processes rows rows, and return its result line"""
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    return {'name': name, 'rows': rows, 'seconds': round(elapsed, 3),
+            'rows_per_sec': round(rows / elapsed) if elapsed else None,
+            'peak_rss_mb': round(peak_rss(), 1)}
+
+
+def time_requests(name, client, urls, cached):
+    """request every url with the test client and return the latency of the requests
+
+    unless cached is True the response cache is emptied before each request so
+    the query and render are timed rather than the cache lookup, when it is True
+    every url is requested once first so each timed request is a cache hit"""
+    if cached:
+        for url in urls:
+            client.get(url)
+    times = []
+    for url in urls:
+        if not cached:
+            app.RESPONSECACHE.clear()
+        start = time.perf_counter()
+        response = client.get(url)
+        times.append(time.perf_counter() - start)
+        if response.status_code != 200:
+            raise RuntimeError(f"{url} returned {response.status_code}")
+    times.sort()
+    return {'name': name, 'requests': len(times),
+            'p50_ms': round(percentile(times, 0.5) * 1000, 2),
+            'p99_ms': round(percentile(times, 0.99) * 1000, 2),
+            'peak_rss_mb': round(peak_rss(), 1)}
+
+
+def consume(rows):
+    """run a generator to the end without keeping what it yields"""
+    for _ in rows:
+        pass
+
+
+def validate(filename, schema):
+    """parse and validate every row of a csv file"""
+    with open(filename, mode='rb') as rawfile:
+        consume(app.isvaliddata(app.read_csv(rawfile), schema))
+
+
+def sqlite_ids(database):
+    """return the ids in the data table of a database"""
+    conn = app.connect_reader(database)
+    try:
+        return conn.execute("SELECT id FROM data;").fetchall()
+    finally:
+        conn.close()
+
+
+def run_scale(scale, requests, seed):
+    """generate the data for one scale, load it and time the pages
+
+        Returns:
+            A list of dictionaries, one for each thing timed
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        folder = Path(folder)
+        factorcsv = folder / 'crashData-CSV.csv'
+        mapcsv = folder / 'mapData-CSV.csv'
+        factorrows = generate(FACTORCSV, factorcsv, scale, seed=seed)
+        maprows = generate(MAPCSV, mapcsv, scale, idcol=0, seed=seed)
+        app.APP.config.update(FACTORDATABASE=str(folder / 'crashData.db'),
+                              MAPDATABASE=str(folder / 'mapData.db'),
+                              FACTORSNAPSHOT=str(folder / 'snapshot' / 'crashData'),
+                              MAPSNAPSHOT=str(folder / 'snapshot' / 'mapData'),
+                              COLUMNSTORE=str(folder / 'mapData-columns.npz'),
+                              TILECACHE=str(folder / 'tiles'),
+                              INGESTMETRICS=str(folder / 'ingest-metrics.json'))
+
+        results.append(time_rows('isvaliddata factor', factorrows,
+                                 lambda: validate(factorcsv, app.FACTORSCHEMA)))
+        results.append(time_rows('isvaliddata map', maprows,
+                                 lambda: validate(mapcsv, app.DATASETS['map']['schema'])))
+        # nothing is serving these databases yet, so they are written in place
+        conn = app.connect_writer(app.APP.config['FACTORDATABASE'])
+        app.initdb_factor(conn)
+        results.append(time_rows('upload_factor', factorrows,
+                                 lambda: app.upload_factor(conn, str(factorcsv))))
+        conn.close()
+        conn = app.connect_writer(app.APP.config['MAPDATABASE'])
+        app.initdb_map(conn)
+        results.append(time_rows('upload_map', maprows, lambda: app.upload_map(conn, str(mapcsv))))
+        conn.close()
+
+        rand = random.Random(seed)
+        factorids = [row[0] for row in sqlite_ids(app.APP.config['FACTORDATABASE'])]
+        mapids = [row[0] for row in sqlite_ids(app.APP.config['MAPDATABASE'])]
+        # list pages from the start and from random points further in
+        factorpages = ['/factorList'] + [f"/factorList?after={rand.choice(factorids)}"
+                                         for _ in range(requests - 1)]
+        mappages = ['/locationList'] + [f"/locationList?after={rand.choice(mapids)}"
+                                        for _ in range(requests - 1)]
+        factordetail = [f"/factorList/{rand.choice(factorids)}" for _ in range(requests)]
+        mapdetail = [f"/locationList/{rand.choice(mapids)}" for _ in range(requests)]
+        client = app.APP.test_client()
+        for name, urls in (('factorList', factorpages), ('locationList', mappages),
+                           ('factor detail', factordetail), ('location detail', mapdetail)):
+            results.append(time_requests(name, client, urls, cached=False))
+            results.append(time_requests(name + ' cached', client, urls, cached=True))
+        app.close_pool()
+    return results
+
+
+def print_results(scale, results):
+    """print the results for one scale as a table"""
+    print(f"scale {scale}x")
+    for result in results:
+        if 'rows' in result:
+            print(f"  {result['name']:<24} {result['rows']:>10} rows {result['seconds']:>9.3f}s "
+                  f"{result['rows_per_sec'] or 0:>10} rows/s  peak {result['peak_rss_mb']:>8.1f}MB")
+        else:
+            print(f"  {result['name']:<24} {result['requests']:>10} reqs p50 {result['p50_ms']:>7.2f}ms "
+                  f"p99 {result['p99_ms']:>7.2f}ms  peak {result['peak_rss_mb']:>8.1f}MB")
+
+
+@click.command()
+@click.option('--scale', type=int, multiple=True, help="copies of the csv files to load, eg 10, 100 or 1000")
+@click.option('--requests', type=int, default=200, help="requests timed for each page")
+@click.option('--seed', type=int, default=1, help="seed for the generated data and the pages requested")
+@click.option('--json', 'jsonfile', type=click.Path(dir_okay=False), help="also save the results to this file")
+@click.option('--child', is_flag=True, hidden=True)
+def main(scale, requests, seed, jsonfile, child):
+    """time loading the csv files and serving pages at each scale, 10x by default"""
+    if child:
+        # run by the parent for a single scale, the results go back as json
+        print(json.dumps(run_scale(scale[0], requests, seed)))
+        return
+    allresults = dict()
+    for size in scale or (10,):
+        done = subprocess.run([sys.executable, __file__, '--child', '--scale', str(size),
+                               '--requests', str(requests), '--seed', str(seed)],
+                              cwd=Path(__file__).parent, capture_output=True, text=True, check=True)
+        # upload_factor and upload_map print their progress first, the results are last
+        results = json.loads(done.stdout.strip().splitlines()[-1])
+        print_results(size, results)
+        allresults[size] = results
+    if jsonfile:
+        Path(jsonfile).write_text(json.dumps(allresults, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""LRU cache of rendered responses, keyed by the version of the data they were built from"""
+import functools
+import hashlib
+import threading
+from collections import OrderedDict
+from flask import request, make_response
+
+
+class ResponseCache:
+    """least recently used cache of response bodies with a limit on their total size"""
+
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """return the entry for key and mark it as recently used, None if it is not cached"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        """add an entry, evicting the least recently used ones until it fits"""
+        size = len(entry['body'])
+        if size > self.maxbytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old['body'])
+            while self.entries and self.size + size > self.maxbytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted['body'])
+            self.entries[key] = entry
+            self.size += size
+
+    def clear(self):
+        """drop every entry"""
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+def cached(cache, version):
+    """decorate a view so its response is cached until the data version changes
+
+    version is called on every request and returns a tuple of the current data
+    version string and when it was loaded.  responses get a strong ETag and
+    Last-Modified, and a matching If-None-Match gets a 304 with no body"""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            tag, loaded = version()
+            key = (request.path, tuple(sorted(request.args.items(multi=True))), tag)
+            entry = cache.get(key)
+            if entry is None:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                body = response.get_data()
+                entry = {'body': body,
+                         'mimetype': response.mimetype,
+                         'etag': hashlib.sha256(body).hexdigest()}
+                cache.put(key, entry)
+            response = make_response(entry['body'])
+            response.mimetype = entry['mimetype']
+            response.set_etag(entry['etag'])
+            if loaded:
+                response.last_modified = loaded
+            # let browsers and proxies keep a copy but check it is still current
+            response.cache_control.no_cache = True
+            return response.make_conditional(request)
+        return wrapper
+    return decorator
@@ -0,0 +1,186 @@
+"""Columnar in-memory copy of the map data for fast filtering and grouping with NumPy
+
+the store is built by the load from the same validated rows it writes to the map
+database, along with csv columns the database does not keep.  numpy is optional,
+if it is not installed the load builds no store, load_store() returns None and
+the analytics api reports that it is unavailable"""
+import os
+from array import array
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# columns stored as numbers, everything else is dictionary encoded
+# missing numbers are stored as -1 (integers) or nan (floats)
+NUMERIC = {'Crash_Ref_Number': 'int64',
+           'Crash_Year': 'int16',
+           'Crash_Hour': 'int8',
+           'Crash_Longitude_GDA94': 'float64',
+           'Crash_Latitude_GDA94': 'float64',
+           'Loc_Post_Code': 'int32',
+           'Count_Casualty_Fatality': 'int32',
+           'Count_Casualty_Hospitalised': 'int32',
+           'Count_Casualty_MedicallyTreated': 'int32',
+           'Count_Casualty_MinorInjury': 'int32',
+           'Count_Casualty_Total': 'int32',
+           'Crash_DCA_Code': 'int16',
+           'Count_Unit_Car': 'int16',
+           'Count_Unit_Motorcycle_Moped': 'int16',
+           'Count_Unit_Truck': 'int16',
+           'Count_Unit_Bus': 'int16',
+           'Count_Unit_Bicycle': 'int16',
+           'Count_Unit_Pedestrian': 'int16',
+           'Count_Unit_Other': 'int16'}
+# array typecode holding each numpy dtype while the store is built
+TYPECODES = {'int64': 'q', 'int32': 'i', 'int16': 'h', 'int8': 'b', 'float64': 'd'}
+AGGREGATES = ('count', 'sum', 'mean', 'min', 'max')
+
+
+def tonumber(value, dtype):
+    """convert a value to a number, using -1 or nan when it is missing"""
+    try:
+        return float(value) if dtype.startswith('float') else int(value)
+    except (TypeError, ValueError):
+        return float('nan') if dtype.startswith('float') else -1
+
+
+class StoreBuilder:
+    """collects the rows a load writes, a batch at a time, and saves them as a store
+
+    the rows are appended to typed arrays so only one batch of python objects is
+    held at a time.  categorical columns are stored as int32 codes plus a separate
+    array of labels, so a column like Loc_Suburb costs 4 bytes a row however long
+    the names are.  kinds are the schema types of the columns, a dict of label to
+    number is turned back into its labels.  base is the ColumnStore an incremental
+    load adds to, its rows come first"""
+
+    def __init__(self, names, kinds, base=None):
+        self.names = list(names)
+        self.decoders = {name: {number: label for label, number in kind.items()}
+                         for name, kind in zip(names, kinds) if isinstance(kind, dict)}
+        self.values = {name: array(TYPECODES[NUMERIC[name]] if name in NUMERIC else 'i')
+                       for name in names}
+        self.labels = {name: dict() for name in names if name not in NUMERIC}
+        self.count = 0
+        if base is not None:
+            for name in names:
+                self.values[name].frombytes(base.columns[name].tobytes())
+                if name in self.labels:
+                    self.labels[name] = {label: code for code, label in enumerate(base.labels[name])}
+            self.count = base.size
+
+    def add(self, rows):
+        """append a batch of validated rows, their values in the order of names"""
+        for row in rows:
+            for name, value in zip(self.names, row):
+                if name in NUMERIC:
+                    self.values[name].append(tonumber(value, NUMERIC[name]))
+                    continue
+                if name in self.decoders:
+                    value = self.decoders[name].get(value)
+                # NULL text is stored as the empty string
+                value = '' if value is None else value
+                self.values[name].append(self.labels[name].setdefault(value, len(self.labels[name])))
+        self.count += len(rows)
+
+    def save(self, storefile, version=None, key=None):
+        """save the arrays to storefile, replacing it in one step
+
+        key is a column of ids where only the first row with each id is kept, the
+        way the database ignores a crash it already has.  version is saved with
+        the arrays so a store built from older data can be spotted
+
+            Returns:
+                Integer, the number of rows stored
+        """
+        arrays = {'meta:version': numpy.array(version or '')}
+        for name in self.names:
+            dtype = NUMERIC.get(name, 'int32')
+            arrays[name] = numpy.frombuffer(self.values[name], dtype=dtype) if self.count else numpy.zeros(0, dtype)
+            if name in self.labels:
+                arrays['labels:' + name] = numpy.array([str(label) for label in self.labels[name]], dtype=str)
+        if key is not None and self.count:
+            _, first = numpy.unique(arrays[key], return_index=True)
+            if len(first) < self.count:
+                first.sort()
+                for name in self.names:
+                    arrays[name] = arrays[name][first]
+        tmpfile = str(storefile) + '.tmp.npz'
+        numpy.savez(tmpfile, **arrays)
+        os.replace(tmpfile, storefile)
+        return len(arrays[self.names[0]]) if self.names else 0
+
+
+class ColumnStore:
+    """numpy arrays for each column of the map data, see StoreBuilder"""
+
+    def __init__(self, arrays):
+        self.version = str(arrays['meta:version']) if 'meta:version' in arrays else None
+        self.columns = {name: arrays[name] for name in arrays if not name.startswith(('labels:', 'meta:'))}
+        self.labels = {name[len('labels:'):]: arrays[name].tolist()
+                       for name in arrays if name.startswith('labels:')}
+        self.codes = {name: {label: code for code, label in enumerate(labels)}
+                      for name, labels in self.labels.items()}
+        self.size = len(next(iter(self.columns.values()))) if self.columns else 0
+
+    def mask(self, filters):
+        """return a boolean array of the rows matching every filter
+
+        filters is a dictionary of column name to a list of accepted values, given
+        as text for both numeric and categorical columns"""
+        result = numpy.ones(self.size, dtype=bool)
+        for name, accepted in filters.items():
+            if name not in self.columns:
+                raise KeyError(name)
+            if name in self.codes:
+                wanted = [self.codes[name][value] for value in accepted if value in self.codes[name]]
+            else:
+                wanted = [tonumber(value, NUMERIC[name]) for value in accepted]
+            result &= numpy.isin(self.columns[name], wanted)
+        return result
+
+    def groupby(self, by, filters=None, value=None, agg='count'):
+        """aggregate value over the rows matching filters, grouped by the column by
+
+            Returns:
+                A list of (group, result) tuples, numeric groups are in order and
+                text groups are in the order they were first loaded
+        """
+        if by not in self.columns:
+            raise KeyError(by)
+        if agg not in AGGREGATES:
+            raise ValueError(f"agg must be one of {AGGREGATES}")
+        if agg != 'count' and value not in NUMERIC:
+            raise ValueError(f"{agg} needs a numeric value column")
+        rows = self.mask(filters or dict())
+        keys, groups = numpy.unique(self.columns[by][rows], return_inverse=True)
+        counts = numpy.bincount(groups, minlength=len(keys))
+        if agg == 'count':
+            results = counts
+        else:
+            data = self.columns[value][rows].astype('float64')
+            if agg in ('sum', 'mean'):
+                results = numpy.bincount(groups, weights=data, minlength=len(keys))
+                if agg == 'mean':
+                    results = results / numpy.maximum(counts, 1)
+            elif agg == 'min':
+                results = numpy.full(len(keys), numpy.inf)
+                numpy.minimum.at(results, groups, data)
+            else:
+                results = numpy.full(len(keys), -numpy.inf)
+                numpy.maximum.at(results, groups, data)
+        if by in self.labels:
+            names = [self.labels[by][key] for key in keys]
+        else:
+            names = keys.tolist()
+        return list(zip(names, results.tolist()))
+
+
+def load_store(storefile):
+    """return a ColumnStore read from storefile, None if numpy or the file is missing"""
+    if numpy is None or not os.path.isfile(storefile):
+        return None
+    with numpy.load(storefile) as arrays:
+        return ColumnStore({name: arrays[name] for name in arrays.files})
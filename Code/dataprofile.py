@@ -0,0 +1,345 @@
+"""Single pass statistics for a csv file, without loading it
+
+every column gets a null count, a distinct count, its most common values and, for
+numbers, the range, mean and a histogram.  a column's values are counted exactly
+until it has more than EXACTVALUES of them, which covers most columns of the crash
+data, then it falls back to summaries of a fixed size: HyperLogLog for the distinct
+count, Misra-Gries for the most common values and a streaming histogram.  so memory
+use does not depend on how big the file is"""
+import bisect
+import csv
+import hashlib
+import json
+import math
+import operator
+import os
+from pathlib import Path
+
+
+# HyperLogLog uses 2 ** PRECISION registers, about 1.6% standard error
+PRECISION = 12
+# bins kept by the streaming histogram, the closest two are merged past this
+MAXBINS = 32
+# values tracked for the most common values
+TOPVALUES = 10
+# distinct values a column is counted exactly for before using the summaries
+EXACTVALUES = 5000
+# rows of each kind of problem kept as examples
+EXAMPLES = 5
+
+
+class DistinctCounter:
+    """HyperLogLog estimate of the number of distinct values seen"""
+
+    def __init__(self, precision=PRECISION):
+        self.precision = precision
+        self.registers = bytearray(2 ** precision)
+
+    def add(self, value):
+        """add a value, only its text matters"""
+        digest = hashlib.blake2b(value.encode('utf8'), digest_size=8).digest()
+        hashed = int.from_bytes(digest, 'big')
+        index = hashed >> (64 - self.precision)
+        rest = hashed & ((1 << (64 - self.precision)) - 1)
+        rank = 64 - self.precision - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def estimate(self):
+        """return the estimated number of distinct values"""
+        size = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / size)
+        raw = alpha * size * size / sum(2.0 ** -register for register in self.registers)
+        zeros = self.registers.count(0)
+        if raw <= 2.5 * size and zeros:
+            # few values, counting the empty registers is more accurate
+            return round(size * math.log(size / zeros))
+        return round(raw)
+
+
+class Histogram:
+    """streaming histogram of numbers as at most maxbins (centre, count) bins
+
+    each value starts as its own bin and the two closest bins are merged when
+    there are too many, as in Ben-Haim and Tom-Tov's streaming parallel decision
+    tree histograms"""
+
+    def __init__(self, maxbins=MAXBINS):
+        self.maxbins = maxbins
+        self.centres = []
+        self.counts = []
+
+    def add(self, value, times=1):
+        """add a number, seen times times, to the histogram"""
+        index = bisect.bisect_left(self.centres, value)
+        if index < len(self.centres) and self.centres[index] == value:
+            self.counts[index] += times
+            return
+        self.centres.insert(index, value)
+        self.counts.insert(index, times)
+        if len(self.centres) > self.maxbins:
+            gaps = list(map(operator.sub, self.centres[1:], self.centres[:-1]))
+            i = gaps.index(min(gaps))
+            count = self.counts[i] + self.counts[i + 1]
+            self.centres[i] = (self.centres[i] * self.counts[i]
+                               + self.centres[i + 1] * self.counts[i + 1]) / count
+            self.counts[i] = count
+            del self.centres[i + 1]
+            del self.counts[i + 1]
+
+    def bins(self):
+        """return the bins as a list of [centre, count]"""
+        return [[round(centre, 6), count] for centre, count in zip(self.centres, self.counts)]
+
+
+class TopValues:
+    """Misra-Gries summary of the most common values
+
+    a value making up more than 1 / (size + 1) of the rows is always kept, the
+    counts are lower bounds.  on columns where no value is that common, like the
+    months, the counts can be well below the real ones, which is why ColumnStats
+    only uses this once a column has too many values to count exactly"""
+
+    def __init__(self, size=TOPVALUES):
+        self.size = size
+        self.counts = dict()
+
+    def start(self, counts):
+        """start from the exact counts of a dictionary of value to count
+
+        the largest size counts are kept less the next largest one, as when two
+        summaries are merged"""
+        largest = sorted(counts.items(), key=lambda pair: -pair[1])
+        floor = largest[self.size][1] if len(largest) > self.size else 0
+        self.counts = {value: count - floor for value, count in largest[:self.size] if count > floor}
+
+    def add(self, value):
+        """count a value"""
+        if value in self.counts:
+            self.counts[value] += 1
+        elif len(self.counts) < self.size:
+            self.counts[value] = 1
+        else:
+            for key in list(self.counts):
+                self.counts[key] -= 1
+                if not self.counts[key]:
+                    del self.counts[key]
+
+    def top(self):
+        """return the values kept as a list of [value, count], most common first"""
+        return sorted(([value, count] for value, count in self.counts.items()),
+                      key=lambda pair: -pair[1])
+
+
+class ColumnStats:
+    """everything profile_csv() keeps for one column
+
+    values are counted in a dictionary until there are more than EXACTVALUES of
+    them, each one is only checked for being a number and hashed once.  past that
+    every value goes to the summaries"""
+
+    def __init__(self, name, nulls):
+        self.name = name
+        self.nulls = nulls
+        self.exact = dict()
+        self.count = 0
+        self.missing = 0
+        self.numbers = 0
+        self.total = 0.0
+        self.squares = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.longest = 0
+        self.negative = 0
+        self.distinct = DistinctCounter()
+        self.histogram = Histogram()
+        self.top = TopValues()
+
+    def add(self, value):
+        """add one value from the csv"""
+        if self.exact is not None:
+            self.exact[value] = self.exact.get(value, 0) + 1
+            if len(self.exact) > EXACTVALUES:
+                self.summarise()
+            return
+        self.top.add(value)
+        self.measure(value, 1)
+
+    def summarise(self):
+        """move the exact counts into the summaries, for a column with too many values"""
+        counts, self.exact = self.exact, None
+        self.top.start({value: count for value, count in counts.items() if value not in self.nulls})
+        for value, count in counts.items():
+            self.measure(value, count)
+
+    def measure(self, value, times):
+        """add a value seen times times to everything but the most common values"""
+        self.count += times
+        if value in self.nulls:
+            self.missing += times
+            return
+        self.longest = max(self.longest, len(value))
+        self.distinct.add(value)
+        try:
+            number = float(value)
+        except ValueError:
+            return
+        if math.isnan(number) or math.isinf(number):
+            return
+        self.numbers += times
+        self.total += number * times
+        self.squares += number * number * times
+        self.negative += times if number < 0 else 0
+        self.minimum = number if self.minimum is None else min(self.minimum, number)
+        self.maximum = number if self.maximum is None else max(self.maximum, number)
+        self.histogram.add(number, times)
+
+    def report(self):
+        """return the statistics as a dictionary for the json file"""
+        exact = self.exact is not None
+        if exact:
+            for value, count in self.exact.items():
+                self.measure(value, count)
+            self.top.counts = {value: count for value, count in self.exact.items() if value not in self.nulls}
+        present = self.count - self.missing
+        result = {'count': self.count,
+                  'nulls': self.missing,
+                  'null_rate': round(self.missing / self.count, 4) if self.count else 0.0,
+                  'distinct': len(self.top.counts) if exact else self.distinct.estimate(),
+                  'exact': exact,
+                  'longest': self.longest,
+                  'top': self.top.top()[:self.top.size]}
+        # a column is numeric if every value that is there is a number
+        if present and self.numbers == present:
+            mean = self.total / self.numbers
+            result.update({'numeric': True,
+                           'min': self.minimum,
+                           'max': self.maximum,
+                           'mean': round(mean, 6),
+                           'stddev': round(math.sqrt(max(self.squares / self.numbers - mean * mean, 0.0)), 6),
+                           'negative': self.negative,
+                           'histogram': self.histogram.bins()})
+        else:
+            result['numeric'] = False
+        return result
+
+
+def profile_csv(filename, nulls=('', 'Unknown'), coordinates=None, bounds=None, columns=None):
+    """read a csv file once and return statistics for it and each of its columns
+
+    columns are the positions of the columns to profile, all of them when None.
+    coordinates is a (longitude column, latitude column) pair and bounds the
+    (minlon, minlat, maxlon, maxlat) the points should be in, rows outside them
+    or at 0,0 are counted as outlying coordinates
+
+        Returns:
+            A dictionary of the statistics, ready to save as json
+    """
+    path = Path(filename)
+    info = path.stat()
+    rows = 0
+    short = []
+    shortrows = 0
+    outliers = []
+    outlying = 0
+    with open(path, mode='r', encoding='utf8', errors='replace', newline='') as csvfile:
+        csvdata = csv.reader(csvfile)
+        header = next(csvdata, [])
+        if columns is None:
+            columns = range(len(header))
+        columns = [index for index in columns if index < len(header)]
+        stats = [ColumnStats(header[index], nulls) for index in columns]
+        where = None
+        if coordinates and all(name in header for name in coordinates):
+            where = [header.index(name) for name in coordinates]
+        for line, row in enumerate(csvdata, start=2):
+            rows += 1
+            if len(row) != len(header):
+                shortrows += 1
+                if len(short) < EXAMPLES:
+                    short.append(line)
+                continue
+            for column, index in zip(stats, columns):
+                column.add(row[index])
+            if where and bounds:
+                try:
+                    lon, lat = float(row[where[0]]), float(row[where[1]])
+                except ValueError:
+                    continue
+                if (lon, lat) == (0, 0) or not (bounds[0] <= lon <= bounds[2] and bounds[1] <= lat <= bounds[3]):
+                    outlying += 1
+                    if len(outliers) < EXAMPLES:
+                        outliers.append([line, lon, lat])
+    return {'file': path.name,
+            'size': info.st_size,
+            'mtime': info.st_mtime,
+            'rows': rows,
+            'bytes_per_row': round(info.st_size / rows, 1) if rows else None,
+            'wrong_width': {'count': shortrows, 'lines': short},
+            'outlying_coordinates': {'count': outlying, 'examples': outliers} if where else None,
+            'columns': {column.name: column.report() for column in stats}}
+
+
+def save_profile(profile, folder):
+    """save the statistics for a csv file to folder/<csv name>.json
+
+        Returns:
+            Path of the file written
+    """
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    target = folder / f"{profile['file']}.json"
+    tmpfile = folder / f"{profile['file']}.json.{os.getpid()}.tmp"
+    tmpfile.write_text(json.dumps(profile, indent=1))
+    os.replace(tmpfile, target)
+    return target
+
+
+def load_profile(filename, folder):
+    """return the saved statistics for a csv file, None if there are none or the file
+    has changed since it was profiled"""
+    path = Path(filename)
+    try:
+        profile = json.loads((Path(folder) / f"{path.name}.json").read_text())
+        info = path.stat()
+    except (OSError, ValueError):
+        return None
+    if profile.get('size') != info.st_size or profile.get('mtime') != info.st_mtime:
+        return None
+    return profile
+
+
+def format_report(profile):
+    """return the statistics as text, one line per column"""
+    lines = [f"{profile['file']}: {profile['rows']} rows, {profile['size']} bytes, "
+             f"{profile['bytes_per_row']} bytes a row"]
+    if profile['wrong_width']['count']:
+        lines.append(f"  {profile['wrong_width']['count']} rows with the wrong number of columns, "
+                     f"lines {profile['wrong_width']['lines']}")
+    if profile['outlying_coordinates']:
+        outlying = profile['outlying_coordinates']
+        lines.append(f"  {outlying['count']} rows with coordinates outside the expected area"
+                     + (f", eg line, lon, lat {outlying['examples']}" if outlying['examples'] else ""))
+    width = max((len(name) for name in profile['columns']), default=0)
+    for name, column in profile['columns'].items():
+        # older profiles have no exact flag, their counts all came from the summaries
+        exact = column.get('exact', False)
+        text = (f"  {name:<{width}}  nulls {column['null_rate']:>7.2%}  "
+                f"distinct {'' if exact else '~'}{column['distinct']:<7}")
+        if column['numeric']:
+            text += (f" {column['min']:g} to {column['max']:g}, mean {column['mean']:g}, "
+                     f"stddev {column['stddev']:g}")
+            if column['negative']:
+                text += f", {column['negative']} negative"
+        elif exact:
+            top = [f"{value!r} {count}" for value, count in column['top'][:3]]
+            if top:
+                text += " top " + ", ".join(top)
+        else:
+            # the summary's counts are lower bounds, and a value seen once may just
+            # be the last one it made room for
+            top = [f"{value!r} at least {count}" for value, count in column['top'][:3] if count > 1]
+            if top:
+                text += " top " + ", ".join(top)
+        lines.append(text)
+    return "\n".join(lines)
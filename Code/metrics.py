@@ -0,0 +1,243 @@
+"""Counters and timers for the app, served in the Prometheus text format by /metrics
+
+the timers for a request are split into the time spent in sqlite (running and
+stepping statements), rendering templates, and everything else the view does,
+which is mostly turning rows into lists and dictionaries.  ingest counters are
+kept in a json file because loads run in the flask cli, not the web server"""
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from flask import g, has_app_context
+
+
+# upper bounds in seconds of the request duration histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# longest statement kept as a label, the rest is cut off
+MAXSTATEMENT = 120
+# when this is a list every statement run is added to it as (connection, sql, parameters),
+# flask data explain uses it to find the statements the app runs
+CAPTURE = None
+HELP = {'crash_http_requests_total': ('counter', "requests handled, by route, method and status"),
+        'crash_http_request_seconds': ('histogram', "time taken to handle a request, by route"),
+        'crash_http_phase_seconds_total': ('counter', "time spent in sqlite, materializing rows "
+                                                      "and rendering templates, by route"),
+        'crash_sqlite_statements_total': ('counter', "sqlite statements run by the web server"),
+        'crash_sqlite_statement_seconds_total': ('counter', "time spent running sqlite statements "
+                                                            "and fetching their rows"),
+        'crash_ingest_rows_total': ('counter', "csv rows loaded, by dataset and whether they "
+                                               "were added or quarantined"),
+        'crash_ingest_batches_total': ('counter', "batches written to the database by loads"),
+        'crash_ingest_seconds_total': ('counter', "time spent reading, validating and writing csv rows")}
+
+
+class Registry:
+    """counters and histograms keyed by metric name and a tuple of label pairs"""
+
+    def __init__(self):
+        self.counters = dict()
+        self.histograms = dict()
+        self.lock = threading.Lock()
+
+    def inc(self, name, labels, amount=1):
+        """add amount to a counter"""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        """add a value to a histogram"""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            buckets, total, count = self.histograms.get(key, ([0] * len(BUCKETS), 0.0, 0))
+            buckets = [hits + (value <= bound) for hits, bound in zip(buckets, BUCKETS)]
+            self.histograms[key] = (buckets, total + value, count + 1)
+
+    def render(self, extra=None):
+        """return every metric in the Prometheus text format
+
+        extra is a dictionary of more counters to include, in the same form as
+        self.counters"""
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = dict(self.histograms)
+        for key, value in (extra or dict()).items():
+            counters[key] = counters.get(key, 0) + value
+        lines = []
+        for name, (kind, text) in HELP.items():
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f"{name}{format_labels(labels)} {value:g}")
+            for (metric, labels), (buckets, total, count) in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                for bound, hits in zip(BUCKETS, buckets):
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', f'{bound:g}'),))} {hits}")
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {count}")
+                lines.append(f"{name}_sum{format_labels(labels)} {total:g}")
+                lines.append(f"{name}_count{format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    """return the {name="value",...} part of a metric line, escaped as the format needs"""
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+REGISTRY = Registry()
+
+
+def add_phase(phase, seconds):
+    """add time to a phase of the current request, if there is one"""
+    if has_app_context() and 'phases' in g:
+        g.phases[phase] = g.phases.get(phase, 0.0) + seconds
+
+
+def statement_labels(database, sql):
+    """return the labels for a statement, a fingerprint of its sql
+
+    the api builds its select list and IN (...) lists from the query string, so
+    both are collapsed to ... and clients cannot add new series just by asking for
+    different columns or values"""
+    statement = re.sub(r'\s+', ' ', sql).strip()
+    statement = re.sub(r'\bSELECT\b.*?\bFROM\b', 'SELECT ... FROM', statement, flags=re.IGNORECASE)
+    statement = re.sub(r'\bIN \([^()]*\)', 'IN (...)', statement, flags=re.IGNORECASE)
+    return {'database': Path(database).name, 'statement': statement[:MAXSTATEMENT]}
+
+
+def record_statement(labels, seconds, count=1):
+    """add to the count and time of a statement, both overall and for the current request"""
+    if count:
+        REGISTRY.inc('crash_sqlite_statements_total', labels, count)
+    REGISTRY.inc('crash_sqlite_statement_seconds_total', labels, seconds)
+    add_phase('db', seconds)
+
+
+class TimedCursor(sqlite3.Cursor):
+    """cursor that times its statement and adds the time spent fetching rows to it
+
+    fetch times are added up on the cursor and recorded once, when the rows run out,
+    the next statement starts or the cursor is closed, so iterating over a big
+    result does not take the registry lock for every row"""
+
+    def __init__(self, conn):
+        super().__init__(conn)
+        self.labels = None
+        self.seconds = 0.0
+        self.count = 0
+
+    def flush(self):
+        """record the time added up for the current statement"""
+        if self.labels is not None and (self.count or self.seconds):
+            record_statement(self.labels, self.seconds, self.count)
+        self.seconds = 0.0
+        self.count = 0
+
+    def timed(self, method, *args):
+        """call a method of the cursor and add how long it took to the statement"""
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            self.seconds += time.perf_counter() - start
+
+    def execute(self, sql, parameters=()):
+        self.flush()
+        if CAPTURE is not None:
+            CAPTURE.append((self.connection, sql, parameters))
+        self.labels = statement_labels(self.connection.database, sql)
+        self.count = 1
+        try:
+            return self.timed(super().execute, sql, parameters)
+        except BaseException:
+            self.flush()
+            raise
+
+    def fetchone(self):
+        row = self.timed(super().fetchone)
+        if row is None:
+            self.flush()
+        return row
+
+    def fetchmany(self, *args):
+        rows = self.timed(super().fetchmany, *args)
+        if not rows:
+            self.flush()
+        return rows
+
+    def fetchall(self):
+        rows = self.timed(super().fetchall)
+        self.flush()
+        return rows
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self.seconds += time.perf_counter() - start
+            self.flush()
+            raise
+        self.seconds += time.perf_counter() - start
+        return row
+
+    def close(self):
+        self.flush()
+        super().close()
+
+    def __del__(self):
+        # a cursor dropped before its rows ran out still counts
+        self.flush()
+
+
+class TimedConnection(sqlite3.Connection):
+    """connection whose statements are timed, use it as the factory argument of
+    sqlite3.connect().  only execute() is timed, it is all the web server uses"""
+
+    def __init__(self, database, *args, **kwargs):
+        super().__init__(database, *args, **kwargs)
+        self.database = database
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        # the builtin execute() makes a plain cursor, so go through cursor() instead
+        return self.cursor().execute(sql, parameters)
+
+
+def read_ingest(filename):
+    """return the ingest counters saved by save_ingest(), in the same form as Registry.counters"""
+    try:
+        saved = json.loads(Path(filename).read_text())
+    except (OSError, ValueError):
+        return dict()
+    return {(item['name'], tuple(tuple(pair) for pair in item['labels'])): item['value']
+            for item in saved}
+
+
+def save_ingest(filename, dataset, added, rejected, batches, seconds):
+    """add the counts from a load to the ingest counters saved in filename"""
+    counters = read_ingest(filename)
+    for name, labels, amount in (('crash_ingest_rows_total', {'dataset': dataset, 'result': 'added'}, added),
+                                 ('crash_ingest_rows_total', {'dataset': dataset, 'result': 'quarantined'},
+                                  rejected),
+                                 ('crash_ingest_batches_total', {'dataset': dataset}, batches),
+                                 ('crash_ingest_seconds_total', {'dataset': dataset}, seconds)):
+        key = (name, tuple(sorted(labels.items())))
+        counters[key] = counters.get(key, 0) + amount
+    tmpfile = f"{filename}.{os.getpid()}.tmp"
+    Path(tmpfile).write_text(json.dumps([{'name': name, 'labels': labels, 'value': value}
+                                         for (name, labels), value in counters.items()]))
+    os.replace(tmpfile, filename)
@@ -0,0 +1,177 @@
+"""Column oriented binary snapshots of the validated csv data
+
+a snapshot is a folder with one file of fixed width values per column and a
+manifest.json describing them.  text columns are dictionary encoded as int32
+codes with the labels kept in the manifest, numbers are int64 or float64.  the
+files are memory mapped when read so opening a snapshot costs next to nothing.
+rows that failed validation are kept in rejected.jsonl with their reason, so a
+load from the snapshot quarantines the same rows at the same lines as one from
+the csv"""
+import json
+import math
+import mmap
+import os
+import shutil
+from array import array
+from pathlib import Path
+
+
+# value written for a NULL integer, NULL floats are nan and NULL text is code -1
+NULLINT = -2 ** 63
+TYPECODES = {'int': 'q', 'float': 'd', 'text': 'i'}
+
+
+def kind_name(kind):
+    """return the snapshot kind for a schema type, a dict of label to ordinal is an int"""
+    if kind is int or isinstance(kind, dict):
+        return 'int'
+    if kind is float:
+        return 'float'
+    return 'text'
+
+
+def write_snapshot(folder, names, kinds, rows, source, batchsize=5000):
+    """write validated rows to a snapshot folder
+
+    rows are (valid, reason, values) tuples as the csv validation yields them, the
+    values of a row that is not valid are the raw csv row.  rows are streamed and
+    written a batch at a time so memory use stays flat, the snapshot is built next
+    to folder and renamed into place when complete
+
+        Returns:
+            A tuple of the number of valid rows and rejected rows written
+    """
+    folder = Path(folder)
+    tmpfolder = folder.with_name(folder.name + '.tmp')
+    shutil.rmtree(tmpfolder, ignore_errors=True)
+    tmpfolder.mkdir(parents=True)
+    kinds = [kind_name(kind) for kind in kinds]
+    labels = [dict() for _ in names]
+    files = [open(tmpfolder / f"{name}.bin", mode='wb') for name in names]
+    buffers = [array(TYPECODES[kind]) for kind in kinds]
+    count = 0
+    rejected = 0
+    rejectfile = open(tmpfolder / 'rejected.jsonl', mode='w', encoding='utf8')
+    try:
+        for position, (valid, reason, row) in enumerate(rows):
+            if not valid:
+                # the position puts it back between the valid rows when read
+                rejectfile.write(json.dumps([position, reason, row]) + "\n")
+                rejected += 1
+                continue
+            for col, value in enumerate(row):
+                if kinds[col] == 'text':
+                    value = -1 if value is None else labels[col].setdefault(value, len(labels[col]))
+                elif value is None:
+                    value = NULLINT if kinds[col] == 'int' else math.nan
+                buffers[col].append(value)
+            count += 1
+            if count % batchsize == 0:
+                for col, buffer in enumerate(buffers):
+                    buffer.tofile(files[col])
+                    del buffer[:]
+        for col, buffer in enumerate(buffers):
+            buffer.tofile(files[col])
+    finally:
+        rejectfile.close()
+        for datafile in files:
+            datafile.close()
+    manifest = {'source': source,
+                'rows': count,
+                'rejected': rejected,
+                'columns': [{'name': name, 'kind': kind} for name, kind in zip(names, kinds)],
+                'labels': {name: list(labels[col]) for col, name in enumerate(names)
+                           if kinds[col] == 'text'}}
+    (tmpfolder / 'manifest.json').write_text(json.dumps(manifest))
+    shutil.rmtree(folder, ignore_errors=True)
+    os.replace(tmpfolder, folder)
+    return (count, rejected)
+
+
+def read_manifest(folder):
+    """return the manifest of a snapshot, None if there is no complete snapshot"""
+    try:
+        return json.loads((Path(folder) / 'manifest.json').read_text())
+    except (OSError, ValueError):
+        return None
+
+
+def open_columns(folder, manifest):
+    """return a memoryview over the memory mapped file of each column"""
+    views = []
+    for column in manifest['columns']:
+        typecode = TYPECODES[column['kind']]
+        if manifest['rows'] == 0:
+            views.append(memoryview(array(typecode)))
+            continue
+        with open(Path(folder) / f"{column['name']}.bin", mode='rb') as datafile:
+            mapped = mmap.mmap(datafile.fileno(), 0, access=mmap.ACCESS_READ)
+        views.append(memoryview(mapped).cast(typecode))
+    return views
+
+
+def read_rejected(folder, manifest):
+    """yield the (position, reason, row) of each rejected row of a snapshot in order"""
+    if not manifest.get('rejected'):
+        return
+    with open(Path(folder) / 'rejected.jsonl', encoding='utf8') as rejectfile:
+        for line in rejectfile:
+            yield json.loads(line)
+
+
+def read_snapshot(folder, source):
+    """yield the rows of a snapshot as the (valid, reason, values) tuples they were
+    written from, or nothing if it was not made from source
+
+    source is the hash of the csv file, a snapshot of an older version of the
+    file is ignored.  use matches() first to tell the two cases apart"""
+    manifest = read_manifest(folder)
+    if not manifest or manifest['source'] != source:
+        return
+    rejected = read_rejected(folder, manifest)
+    nextreject = next(rejected, None)
+    position = 0
+    views = open_columns(folder, manifest)
+    decoders = []
+    for column in manifest['columns']:
+        if column['kind'] == 'text':
+            decoders.append(manifest['labels'][column['name']] + [None])
+        else:
+            decoders.append(column['kind'])
+    for index in range(manifest['rows']):
+        while nextreject and nextreject[0] == position:
+            yield (False, nextreject[1], nextreject[2])
+            nextreject = next(rejected, None)
+            position += 1
+        row = []
+        for view, decoder in zip(views, decoders):
+            value = view[index]
+            if decoder == 'int':
+                row.append(None if value == NULLINT else value)
+            elif decoder == 'float':
+                row.append(None if math.isnan(value) else value)
+            else:
+                # -1 picks the None on the end of the labels
+                row.append(decoder[value])
+        yield (True, None, tuple(row))
+        position += 1
+    while nextreject:
+        yield (False, nextreject[1], nextreject[2])
+        nextreject = next(rejected, None)
+
+
+def matches(folder, source, names=None, kinds=None):
+    """check whether the snapshot in folder was made from the csv with hash source
+
+    with names and kinds the columns must match them too, so a snapshot written
+    before the schema changed is not used"""
+    manifest = read_manifest(folder)
+    # snapshots from before rejected rows were kept would lose them from the quarantine
+    if manifest is None or manifest['source'] != source or 'rejected' not in manifest:
+        return False
+    if names is not None and [column['name'] for column in manifest['columns']] != list(names):
+        return False
+    if kinds is not None and [column['kind'] for column in manifest['columns']] != [kind_name(kind)
+                                                                                    for kind in kinds]:
+        return False
+    return True
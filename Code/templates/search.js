@@ -1,15 +0,0 @@
-function search() {
-  var input, filter, ul, li, a, i;
-  input = document.getElementById("searchBar");
-  filter = input.value.toUpperCase();
-  ul = document.getElementById("list");
-  li = ul.getElementsByTagName("li");
-  for (i = 0; i < li.length; i++) {
-    a = li[i].getElementsByTagName("a")[0];
-    if (a.innerHTML.toUpperCase().indexOf(filter) > 0) {
-    li[i].style.display = "";
-    } else {
-    li[i].style.display = "none";
-    }
-  }
-}
\ No newline at end of file
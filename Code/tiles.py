@@ -0,0 +1,70 @@
+"""Density tiles for the crash map, using the usual z/x/y web mercator tile scheme
+
+tiles are built from counts of crashes in a grid of cells over the tile and can be
+returned as the grid itself (json) or as a png heatmap"""
+import math
+import struct
+import zlib
+
+
+TILESIZE = 256
+# cells across a tile, each cell is TILESIZE / GRIDSIZE pixels square
+GRIDSIZE = 64
+# a cell with this many crashes or more gets the strongest colour
+MAXCOUNT = 50
+
+
+def tile_bounds(z, x, y):
+    """return the (minlon, minlat, maxlon, maxlat) covered by a tile"""
+    tiles = 2 ** z
+    minlon = x / tiles * 360 - 180
+    maxlon = (x + 1) / tiles * 360 - 180
+    maxlat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / tiles))))
+    minlat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / tiles))))
+    return (minlon, minlat, maxlon, maxlat)
+
+
+def bin_points(points, z, x, y):
+    """count the (lon, lat) points falling in each cell of the tile
+
+        Returns:
+            A list of GRIDSIZE rows of GRIDSIZE counts, the first row is the top of the tile
+    """
+    tiles = 2 ** z
+    grid = [[0] * GRIDSIZE for _ in range(GRIDSIZE)]
+    for lon, lat in points:
+        if lat is None or lon is None or not -85.0511 < lat < 85.0511:
+            continue
+        sinlat = math.sin(math.radians(lat))
+        col = int(((lon + 180) / 360 * tiles - x) * GRIDSIZE)
+        row = int(((0.5 - math.log((1 + sinlat) / (1 - sinlat)) / (4 * math.pi)) * tiles - y) * GRIDSIZE)
+        if 0 <= col < GRIDSIZE and 0 <= row < GRIDSIZE:
+            grid[row][col] += 1
+    return grid
+
+
+def colour(count):
+    """return the rgba colour for a cell, transparent when there are no crashes"""
+    if count == 0:
+        return b'\x00\x00\x00\x00'
+    heat = min(1.0, math.log1p(count) / math.log1p(MAXCOUNT))
+    # yellow for one crash through to red for MAXCOUNT
+    return bytes((255, int(220 * (1 - heat)), 0, int(120 + 135 * heat)))
+
+
+def png_chunk(kind, data):
+    """return a png chunk with its length and crc"""
+    return (struct.pack('>I', len(data)) + kind + data
+            + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+
+def render_png(grid):
+    """return the bytes of a TILESIZE square rgba png showing the grid as a heatmap"""
+    scale = TILESIZE // GRIDSIZE
+    lines = []
+    for cells in grid:
+        line = b'\x00' + b''.join(colour(count) * scale for count in cells)
+        lines.extend([line] * scale)
+    header = struct.pack('>IIBBBBB', TILESIZE, TILESIZE, 8, 6, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + png_chunk(b'IHDR', header)
+            + png_chunk(b'IDAT', zlib.compress(b''.join(lines), 6)) + png_chunk(b'IEND', b''))